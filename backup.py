@@ -3,19 +3,35 @@
 """Backup tool
 
 Usage:
-  backup.py init <name> [--force]
+  backup.py init <name> [--force] [--jobs=<n>] [--rehash] [--algorithm=<name>] [--profile] [--profile-dump=<file>]
   backup.py init from <name> as <backup-name> [--force]
-  backup.py update [--checksum]
-  backup.py status [--force] [--checksum]
-  backup.py status [show|verify|clean]
-  backup.py treat new [--delete]
-  backup.py treat (missing|updated|moved|all)
+  backup.py update [--force] [--checksum] [--fingerprint] [--jobs=<n>] [--rehash] [--profile] [--profile-dump=<file>]
+  backup.py status [--force] [--checksum] [--fingerprint] [--quick] [--all-copies] [--jobs=<n>] [--rehash] [--profile] [--profile-dump=<file>]
+  backup.py status [show|clean]
+  backup.py status verify [--deep] [--jobs=<n>]
+  backup.py treat new [--delete] [--jobs=<n>]
+  backup.py treat (missing|updated|moved|all) [--jobs=<n>]
+  backup.py treat resume [--jobs=<n>]
+  backup.py watch
+  backup.py dedup [--jobs=<n>] [--write]
+  backup.py db migrate (text|sqlite)
+  backup.py db algorithm <algorithm>
   backup.py config 
   backup.py debug info
   backup.py (-h | --help)
 
 Options:
-  -v, --verbose    Print more text.
+  -v, --verbose       Print more text.
+  --fingerprint       Compare samples of the files, not only their size.
+  --quick             Only scan the directories changed since the last complete status.
+  --all-copies        Get the status of all the copies of the repository, concurrently.
+  --jobs=<n>          Number of files hashed (or copied by `treat`) concurrently.
+  --rehash            Ignore the checksum cache.
+  --algorithm=<name>  Checksum algorithm of the repository (md5, sha1, blake2b...).
+  --write             Write the duplicated files in the copy tmp dir.
+  --deep              Hash the good files again (`status verify`).
+  --profile           Print the time spent in each phase of the command.
+  --profile-dump=<file>  Save cProfile statistics of the command in <file> (pstats).
 """
 
 from docopt import docopt
@@ -34,11 +50,14 @@ import logging
 
 def init_logging():
     LOG_LEVEL = logging.DEBUG
-    LOGFORMAT = "  %(log_color)s%(levelname)-8s%(reset)s | %(log_color)s%(message)s%(reset)s"
-    from colorlog import ColoredFormatter
     logging.root.setLevel(LOG_LEVEL)
-    formatter = ColoredFormatter(LOGFORMAT)
     stream = logging.StreamHandler()
+    if stream.stream.isatty():
+        # colors only on a terminal, colorlog isn't imported otherwise
+        from colorlog import ColoredFormatter
+        formatter = ColoredFormatter("  %(log_color)s%(levelname)-8s%(reset)s | %(log_color)s%(message)s%(reset)s")
+    else:
+        formatter = logging.Formatter("  %(levelname)-8s | %(message)s")
     stream.setLevel(LOG_LEVEL)
     stream.setFormatter(formatter)
 
@@ -48,16 +67,25 @@ def init_logging():
 
     return log
 
-
-init_logging()
 log = logging.getLogger('backup.dispatch')
 
-import init, config, status, verify, info, update, treat
+# the modules of the commands are imported when needed, to start faster
+import config, profiling
 
 def main(args):
+    init_logging()
+
     try: os.mkdir(config.CONFIG_PATH)
     except FileExistsError: pass # ignore
 
+    profiling.enabled = args["--profile"]
+    
+    profiler = None
+    if args["--profile-dump"]:
+        import cProfile
+        profiler = cProfile.Profile() # main thread only
+        profiler.enable()
+
     try:
         if config.NOP:
             log.critical("************************")
@@ -65,21 +93,38 @@ def main(args):
             log.critical("************************")
         #################
         if args["init"]:
+            import init
             init.do_init(args)
             
         elif args["update"]:
+            import update
             update.do_update(args)
             
         elif args["status"]:
+            import status
             status.do_status(args)
 
         elif args["treat"]:
+            import treat
             treat.do_treat(args)
             
+        elif args["watch"]:
+            import watch
+            watch.do_watch(args)
+            
+        elif args["dedup"]:
+            import dedup
+            dedup.do_dedup(args)
+            
+        elif args["db"]:
+            import storage
+            storage.do_db(args)
+            
         elif args["config"]:
             log.warn("cannot configure yet")
             
         elif args["debug"] and args["info"]:
+            import info
             info.do_info(args)
         else:
             print(__doc__)
@@ -97,6 +142,13 @@ def main(args):
             log.critical("Critical failure, bye ...")
             log.critical(e)
     finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args["--profile-dump"])
+            log.info("cProfile statistics saved in {}.".format(args["--profile-dump"]))
+            
+        if profiling.enabled:
+            profiling.report()
         
         # print("---")
         # print("  "+"\n  ".join("{:10s}->  {}".format(k, v) for k, v in args.items() if v))
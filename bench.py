@@ -0,0 +1,298 @@
+#! /usr/bin/python3
+
+"""backup.py benchmarks
+
+Usage:
+  bench.py hash [<file>] [--size=<mb>] [--algorithms=<list>] [--buffers=<list>]
+  bench.py tree <dir> [--files=<n>] [--mean-size=<kb>] [--seed=<n>]
+  bench.py run [--files=<n>] [--mean-size=<kb>] [--seed=<n>] [--jobs=<n>] [--changes=<list>] [--dir=<dir>] [--output=<file>] [--keep]
+  bench.py (-h | --help)
+
+Options:
+  --size=<mb>          Size of the temporary file to hash [default: 256].
+  --algorithms=<list>  Comma-separated checksum algorithms [default: md5,sha1,sha256,blake2b].
+  --buffers=<list>     Comma-separated read sizes in KiB, 0 for mmap [default: 4,64,1024,8192,0].
+  --files=<n>          Number of files of the synthetic tree, like 10k, 100k or 1M [default: 10k].
+  --mean-size=<kb>     Mean size of the pictures, in KiB [default: 64].
+  --seed=<n>           Seed of the synthetic tree [default: 0].
+  --jobs=<n>           Passed to the commands [default: 1].
+  --changes=<list>     Fractions of new,missing,modified,moved files [default: 0.01,0.01,0.01,0.01].
+  --dir=<dir>          Where to create the temporary trees.
+  --output=<file>      Write the JSON results in <file> instead of stdout.
+  --keep               Don't remove the trees when done.
+"""
+
+from docopt import docopt
+
+import os, sys, time
+import json
+import random
+import shutil
+import subprocess
+import tempfile
+import zlib
+
+import common, config
+
+def bench_hash(fname, algorithms, buffer_sizes):
+    size = os.path.getsize(fname)
+    
+    # warm the page cache, to measure the hashing and not the disk
+    common.hash_file(fname, "md5", 1024*1024)
+
+    print("{} MB, {}".format(size // (1024*1024), fname))
+    print("{:10s} {:>10s} {:>10s}".format("algorithm", "buffer", "MB/s"))
+    
+    for algorithm in algorithms:
+        for buffer_size in buffer_sizes:
+            start = time.perf_counter()
+            if buffer_size:
+                common.hash_file(fname, algorithm, buffer_size)
+            else:
+                common.hash_file(fname, algorithm, 0, mmap_size=0)
+            duration = time.perf_counter() - start
+            
+            print("{:10s} {:>10s} {:10.1f}".format(algorithm,
+                                                   "{}K".format(buffer_size // 1024) if buffer_size else "mmap",
+                                                   size / duration / (1024*1024)))
+
+# Synthetic photo library: one picture per file of images/<year>/<month>/,
+# with its thumbnail at the same path under miniatures/. The content of
+# the files only depends on the seed and on their path.
+
+BLOCK_SIZE = 1024*1024
+FILES_PER_DIR = 200
+
+def parse_count(count):
+    multiplier = {"k": 1000, "M": 1000*1000}.get(count[-1], 1)
+    return int(count.rstrip("kM")) * multiplier
+
+def tree_layout(nb_files, mean_size, seed):
+    # returns [(relpath, size)], `nb_files` files whose pictures
+    # are around `mean_size` bytes (log-normal)
+    rnd = random.Random(seed)
+    
+    layout = []
+    for idx in range(nb_files // 2):
+        year, month = 2000 + idx // (12*FILES_PER_DIR), 1 + idx // FILES_PER_DIR % 12
+        name = "{}/{:02d}/IMG_{:07d}.jpg".format(year, month, idx)
+        
+        size = int(rnd.lognormvariate(0, 0.5) * mean_size / 1.13) # mean of lognormvariate(0, 0.5)
+        layout.append(("images/" + name, size))
+        layout.append(("miniatures/" + name, size // 20 + 1))
+        
+    return layout
+
+class TreeWriter():
+    def __init__(self, seed):
+        rnd = random.Random(seed)
+        self.block = rnd.getrandbits(8*BLOCK_SIZE).to_bytes(BLOCK_SIZE, "little")
+        
+    def write(self, fullpath, size, version=0):
+        # the header makes each file (and each version of it) unique
+        header = "{}:{}\n".format(fullpath, version).encode()
+        offset = zlib.crc32(header) % BLOCK_SIZE
+        
+        os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+        with open(fullpath, "wb") as out_f:
+            out_f.write(header[:size])
+            size -= min(len(header), size)
+            
+            while size:
+                chunk = self.block[offset:offset+size]
+                out_f.write(chunk)
+                size -= len(chunk)
+                offset = 0
+
+def generate_tree(fs_dir, layout, seed):
+    writer = TreeWriter(seed)
+    for relpath, size in layout:
+        writer.write(os.path.join(fs_dir, relpath), size)
+
+def clone_tree(src_dir, dst_dir, layout):
+    # hard links, files are never modified in place
+    for relpath, _ in layout:
+        dst = os.path.join(dst_dir, relpath)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.link(os.path.join(src_dir, relpath), dst)
+
+def change_tree(fs_dir, layout, changes, seed):
+    # returns the new layout
+    rnd = random.Random(seed + 1)
+    writer = TreeWriter(seed)
+    
+    nb_new, nb_missing, nb_modified, nb_moved = [int(len(layout) * fraction) for fraction in changes]
+    
+    changed = rnd.sample(range(len(layout)), nb_missing + nb_modified + nb_moved)
+    missing = set(changed[:nb_missing])
+    modified = set(changed[nb_missing:nb_missing+nb_modified])
+    moved = set(changed[nb_missing+nb_modified:])
+    
+    new_layout = []
+    for idx, (relpath, size) in enumerate(layout):
+        fullpath = os.path.join(fs_dir, relpath)
+        
+        if idx in missing:
+            os.remove(fullpath)
+            continue
+        
+        if idx in modified:
+            # half of them keep their size, only --checksum can see them
+            os.remove(fullpath) # don't write through the hard links
+            size = size if idx % 2 else size + 1
+            writer.write(fullpath, size, version=1)
+        elif idx in moved:
+            relpath = relpath.replace("/IMG_", "/sorted/IMG_")
+            os.makedirs(os.path.dirname(os.path.join(fs_dir, relpath)), exist_ok=True)
+            os.rename(fullpath, os.path.join(fs_dir, relpath))
+            
+        new_layout.append((relpath, size))
+        
+    for idx in range(nb_new):
+        relpath, size = "images/new/IMG_{:07d}.jpg".format(idx), layout[idx][1]
+        writer.write(os.path.join(fs_dir, relpath), size, version=2)
+        new_layout.append((relpath, size))
+    
+    return new_layout
+
+def run_command(home, fs_dir, command, jobs, stdin=""):
+    # runs backup.py in a child process, returns its wall time,
+    # peak RSS (KiB) and whether it failed
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backup.py")]
+    cmd += command.split()
+    if jobs is not None:
+        cmd.append("--jobs={}".format(jobs))
+        
+    env = dict(os.environ, HOME=home) # config.CONFIG_PATH is under $HOME
+    
+    with open(os.path.join(home, "bench.log"), "a+") as log_f:
+        print("$ cd {} && {}".format(fs_dir, " ".join(cmd)), file=log_f, flush=True)
+        start_pos = log_f.tell()
+        
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=fs_dir, env=env, stdin=subprocess.PIPE,
+                                stdout=log_f, stderr=log_f)
+        proc.stdin.write(stdin.encode())
+        proc.stdin.close()
+        
+        _, _, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = 0 # already reaped
+        wall = time.perf_counter() - start
+        
+        log_f.seek(start_pos)
+        failed = "Traceback" in log_f.read()
+        
+    return wall, rusage.ru_maxrss, failed
+
+def bench_run(work_dir, nb_files, mean_size, seed, jobs, changes):
+    home = os.path.join(work_dir, "home")
+    master_dir = os.path.join(work_dir, "master")
+    copy_dir = os.path.join(work_dir, "copy")
+    os.makedirs(os.path.join(home, ".config"))
+    
+    layout = tree_layout(nb_files, mean_size, seed)
+    generate_tree(master_dir, layout, seed)
+    
+    results = []
+    def step(name, fs_dir, command, nb_files, nb_bytes, jobs=jobs, stdin="", record=True):
+        # nb_bytes: what the command has to read (or copy), 0 if only stat'ed
+        wall, max_rss, failed = run_command(home, fs_dir, command, jobs, stdin)
+        if not record:
+            return
+        
+        mb_per_s = round(nb_bytes / wall / (1024*1024), 1) if nb_bytes else None
+        results.append({"step": name, "command": command,
+                        "wall": round(wall, 3), "files": nb_files, "bytes": nb_bytes,
+                        "files_per_s": round(nb_files / wall, 1), "mb_per_s": mb_per_s,
+                        "max_rss_kb": max_rss, "failed": failed})
+        print("{:30s} {:8.2f}s {:10.1f} files/s {:>8s} MB/s {:8d} KiB{}".format(
+                name, wall, nb_files / wall, str(mb_per_s or "-"), max_rss,
+                " FAILED" if failed else ""), file=sys.stderr)
+        
+    total_size = sum(size for _, size in layout)
+    
+    step("init", master_dir, "init bench", len(layout), total_size)
+    clone_tree(master_dir, copy_dir, layout)
+    step("init from", copy_dir, "init from bench as copy", 0, 0, jobs=None, record=False)
+    
+    layout = change_tree(master_dir, layout, changes, seed)
+    total_size = sum(size for _, size in layout)
+    
+    step("status", master_dir, "status --force", len(layout), 0)
+    step("status --checksum", master_dir, "status --force --checksum", len(layout), total_size)
+    step("status --checksum --rehash", master_dir, "status --force --checksum --rehash", len(layout), total_size)
+    step("update", master_dir, "update", len(layout), 0) # only new and modified files are hashed
+    
+    # the copy is behind master: missing files are copied from master,
+    # the ones removed from master come back as new files.
+    step("status (copy)", copy_dir, "status --force", len(layout), 0, record=False)
+    to_copy = set()
+    for status_file in (config.NEW_FILES, config.MISSING_FILES):
+        status_path = os.path.join(home, ".config", "backup.py", "bench", "copy", status_file)
+        with open(status_path) as status_f:
+            to_copy.update(line.partition(" -> ")[0] for line in status_f)
+    copy_size = sum(os.path.getsize(os.path.join(copy_dir, relpath))
+                    if os.path.exists(os.path.join(copy_dir, relpath))
+                    else os.path.getsize(os.path.join(master_dir, relpath))
+                    for relpath in to_copy)
+    # skip the file browser, then confirm, for each category
+    step("treat", copy_dir, "treat all", len(to_copy), copy_size, stdin="s\n\n" * 4)
+    
+    return results
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(args):
+    if args["hash"]:
+        algorithms = args["--algorithms"].split(",")
+        buffer_sizes = [int(size) * 1024 for size in args["--buffers"].split(",")]
+        
+        if args["<file>"]:
+            bench_hash(args["<file>"], algorithms, buffer_sizes)
+            return
+        
+        with tempfile.NamedTemporaryFile(prefix="bench-hash.") as tmp_f:
+            chunk = os.urandom(1024*1024)
+            for _ in range(int(args["--size"])):
+                tmp_f.write(chunk)
+            tmp_f.flush()
+                
+            bench_hash(tmp_f.name, algorithms, buffer_sizes)
+            
+    elif args["tree"]:
+        layout = tree_layout(parse_count(args["--files"]), int(args["--mean-size"]) * 1024,
+                             int(args["--seed"]))
+        generate_tree(args["<dir>"], layout, int(args["--seed"]))
+        
+    elif args["run"]:
+        nb_files, seed = parse_count(args["--files"]), int(args["--seed"])
+        changes = [float(fraction) for fraction in args["--changes"].split(",")]
+        
+        work_dir = tempfile.mkdtemp(prefix="bench-run.", dir=args["--dir"])
+        try:
+            results = bench_run(work_dir, nb_files, int(args["--mean-size"]) * 1024, seed,
+                                int(args["--jobs"]), changes)
+        finally:
+            if args["--keep"]:
+                print("Trees kept in {}".format(work_dir), file=sys.stderr)
+            else:
+                shutil.rmtree(work_dir)
+                
+        report = {"revision": git_revision(), "python": sys.version.split()[0],
+                  "files": nb_files, "mean_size": int(args["--mean-size"]) * 1024,
+                  "seed": seed, "jobs": int(args["--jobs"]), "changes": changes,
+                  "results": results}
+        
+        if args["--output"]:
+            with open(args["--output"], "w") as out_f:
+                json.dump(report, out_f, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+        
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -1,12 +1,17 @@
-import sys, os, yaml
+import sys, os
+import json
 import hashlib
+import collections
+import mmap
+import threading
+import concurrent.futures
 
 import logging; log = logging.getLogger('common')
 from collections import OrderedDict
-import config
+import config, profiling, scheduler
 
-def print_filesystem(fs_dir, out_f=sys.stdout, do_checksum=True):
-    for a_file in browse_filesystem(fs_dir, do_checksum):
+def print_filesystem(fs_dir, out_f=sys.stdout, do_checksum=True, jobs=1, cache=None):
+    for a_file in browse_filesystem(fs_dir, do_checksum, jobs, cache):
         if a_file is False:
             # end of filesystem files
             continue # or return, it's the same
@@ -15,64 +20,340 @@ def print_filesystem(fs_dir, out_f=sys.stdout, do_checksum=True):
                 print("---")
             continue
         
-        print_a_file(a_file, out_f)
+        fullpath, relpath, info = a_file
+        print_a_file(relpath, info, out_f)
 
         
 def print_a_file(relpath, info, out_f):
-    info_str = ", ".join([ "{}: {}".format(k, v) for k,v in info.items()])
-    print("{} -> {}".format(relpath, info_str), file=out_f)
+    print("{} -> {}".format(relpath, format_info(info)), file=out_f)
+
+def format_info(info):
+    return ", ".join([ "{}: {}".format(k, v) for k,v in info.items()])
+
+def parse_info(info_txt):
+    info = OrderedDict()
+    for item in info_txt.split(", "):
+        key, _, value = item.partition(": ")
+        info[key] = value
+    return info
+
+def path_key(relpath):
+    # order of walk_filesystem: files of a directory (sorted),
+    # then its subdirectories (sorted), recursively.
+    dirname, _, name = relpath.rpartition("/")
     
-def get_file_info(fullpath, do_checksum):
-    return OrderedDict((("md5sum", checksum(fullpath) if do_checksum else ""),
-                       ("size", str(os.stat(fullpath).st_size))))
+    return (tuple(dirname.split("/")) if dirname else ()), name
+    
+def get_file_info(fullpath, do_checksum, cache=None, st=None, algorithm="md5", do_fingerprint=False):
+    if st is None:
+        st = os.stat(fullpath)
 
-def browse_filesystem(fs_dir, do_checksum):
-    for dirpath, dirnames, files in os.walk(fs_dir):
+    md5sum = ""
+    if do_checksum:
+        md5sum = cache.get(st, algorithm) if cache is not None else None
+        if md5sum:
+            profiling.count("hash cache", files=1, nbytes=st.st_size)
         
-        for ign in config.TO_IGNORE:
-            try:
-                dirnames.remove(ign)
-            except ValueError: pass # ign was not in the list
-        dirnames.sort()
-        files.sort()
-
-        for name in sorted(files):
-            fullpath = os.path.join(dirpath, name)
+        if not md5sum or digest_algorithm(md5sum) != algorithm:
+            md5sum = checksum(fullpath, algorithm)
+
+            # don't cache if the file changed while we were reading it
+            if cache is not None and os.stat(fullpath).st_mtime_ns == st.st_mtime_ns:
+                cache.put(st, md5sum)
             
-            relpath = fullpath[len(fs_dir)+1:]
+    info = OrderedDict((("md5sum", md5sum),
+                        ("size", str(st.st_size))))
 
-            yield fullpath, relpath, get_file_info(fullpath, do_checksum)
+    if do_fingerprint:
+        info["fingerprint"] = fingerprint(fullpath, st.st_size)
+            
+    return info
+
+def walk_filesystem(fs_dir, top=None, recursive=True):
+    # Depth-first, the files of a directory then its subdirectories,
+    # both sorted by name (see path_key). Yields (fullpath, relpath, DirEntry),
+    # so that the stat() done by scandir can be reused.
+    # `top`: only walk this directory of fs_dir (relpaths stay relative to fs_dir).
+    ignored = set(config.TO_IGNORE)
+    to_visit = [top or fs_dir]
+    
+    while to_visit:
+        dirpath = to_visit.pop()
+        
+        try:
+            with profiling.phase("walk") as timer, os.scandir(dirpath) as dir_it:
+                entries = sorted(dir_it, key=lambda entry: entry.name)
+                timer.add(files=len(entries))
+        except OSError as e:
+            log.warning("Cannot list directory {}: {}".format(dirpath, e))
+            entries = []
+            
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir():
+                # ignored directories are not even listed,
+                # symlinks to directories are not followed (like os.walk)
+                if entry.name not in ignored and not entry.is_symlink():
+                    subdirs.append(entry.path)
+                continue
+
+            yield entry.path, entry.path[len(fs_dir)+1:], entry
             
         yield None # end if dir
+
+        if recursive:
+            to_visit += reversed(subdirs)
         
     yield False # end of FS
 
+def browse_filesystem(fs_dir, do_checksum, jobs=1, cache=None, algorithm="md5", do_fingerprint=False,
+                      db_entries=None):
+    # db_entries: database.browse(), with do_checksum: the files whose entry
+    # has the checksum of another algorithm are hashed with it too, in
+    # info["previous_md5sum"] (see status.compare_entries)
+    def file_info(entry):
+        fullpath, relpath, dir_entry, previous = entry
+        with profiling.phase("stat", files=1):
+            st = dir_entry.stat()
+
+        info = get_file_info(fullpath, do_checksum, cache, st, algorithm, do_fingerprint)
+        if previous:
+            info["previous_md5sum"] = get_file_info(fullpath, True, cache, st, previous)["md5sum"]
+            
+        return fullpath, relpath, info
+
+    entries = previous_algorithms(walk_filesystem(fs_dir), db_entries, algorithm)
+    
+    # without checksum, get_file_info is a single stat: no need for workers
+    if not (do_checksum or do_fingerprint):
+        return ordered_map(file_info, entries)
+
+    def read_key(entry):
+        fullpath, relpath, dir_entry, previous = entry
+        return scheduler.read_key(fullpath, dir_entry)
+
+    def prefetch(entry):
+        fullpath, relpath, dir_entry, previous = entry
+        readahead(fullpath, cache, dir_entry.stat(), algorithm)
+
+    return scheduler.scheduled_map(file_info, entries, jobs, read_key,
+                                   prefetch if do_checksum else None)
+
+def previous_algorithms(entries, db_entries, algorithm):
+    # adds to the walk entries the algorithm of the checksum of their
+    # database entry if it isn't `algorithm` (hashed before `db algorithm`),
+    # None otherwise. db_entries is read along, in the same order.
+    db_entry = next(db_entries) if db_entries is not None else False
+    for entry in entries:
+        if not entry:
+            yield entry
+            continue
+
+        fullpath, relpath, dir_entry = entry
+        while db_entry and path_key(db_entry[0]) < path_key(relpath):
+            db_entry = next(db_entries)
+
+        previous = None
+        if db_entry and db_entry[0] == relpath and db_entry[1]["md5sum"]:
+            previous = digest_algorithm(db_entry[1]["md5sum"])
+        yield fullpath, relpath, dir_entry, previous if previous != algorithm else None
+
+def ordered_map(func, entries, jobs=1):
+    # None/False entries (end of dir/FS) are passed through untouched.
+    if jobs <= 1:
+        for entry in entries:
+            yield func(entry) if entry else entry
+        return
+
+    # results are yielded in the order of `entries`, with at most
+    # jobs*HASH_WINDOW entries in flight, whatever the speed of the workers.
+    window = collections.deque()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        for entry in entries:
+            window.append(executor.submit(func, entry) if entry else entry)
+
+            if len(window) >= jobs * config.HASH_WINDOW:
+                yield resolve_entry(window.popleft())
+
+        while window:
+            yield resolve_entry(window.popleft())
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def resolve_entry(entry):
+    return entry.result() if entry else entry
+
+def get_jobs(args):
+    jobs = args.get("--jobs")
+    
+    return int(jobs) if jobs else config.HASH_JOBS
+
+# First line of the text database, written by storage.TextDatabase.write:
+#   #backup.py entries: 000000031770
+# the values are padded so that the header can be rewritten in place.
+DB_HEADER = "#backup.py "
+
+def format_db_header(header):
+    return DB_HEADER + format_info(header)
+
+def parse_db_header(line):
+    if not line.startswith(DB_HEADER):
+        return None
+    
+    return parse_info(line[len(DB_HEADER):].rstrip("\n"))
+
 def db_length(db_fname):
-    with open(db_fname) as db_f:
-        return len(db_f.readlines())
+    with open(db_fname, "rb") as db_f:
+        first_line = db_f.readline()
+
+        header = parse_db_header(first_line.decode())
+        if header and "entries" in header:
+            return int(header["entries"])
+
+        # no header (older database), count the lines without decoding them
+        nb_lines = 1 if first_line else 0
+        for chunk in iter(lambda: db_f.read(config.DB_READ_SIZE), b""):
+            nb_lines += chunk.count(b"\n")
+            
+        return nb_lines
+
+def db_lines(db_f):
+    # lines of the database, without the header
+    if config.DB_MMAP:
+        lines = mmap_lines(db_f)
+    else:
+        lines = iter(db_f)
         
+    for line in lines:
+        if parse_db_header(line) is None:
+            yield line
+        break
+
+    yield from lines
+
+def mmap_lines(db_f):
+    try:
+        with mmap.mmap(db_f.fileno(), 0, access=mmap.ACCESS_READ) as db_map:
+            for line in iter(db_map.readline, b""):
+                yield line.decode()
+    except ValueError:
+        pass # empty file, cannot be mapped
+    
 def browse_db(db_fname):
     with open(db_fname) as db_f:
-        for line in db_f.readlines():
-            relpath, _, info_txt = line[:-1].partition(" -> ")
-            info_lst = info_txt.split(", ")
-            info = OrderedDict((item.split(": ")[0], item.split(": ")[1]) for item in info_lst)
+        for line in db_lines(db_f):
+            relpath, _, info_txt = line.rstrip("\n").partition(" -> ")
 
-            yield relpath, info
+            yield relpath, parse_info(info_txt)
     yield False
 
-def progress(current, total):
-    print("\r%.2f%%" % (current/total*100), end="")
-        
-def checksum(fname):
-    hashval = hashlib.md5()
+# The `md5sum` field of the entries holds the checksum of the files.
+# md5 checksums are stored as is, the others are prefixed with their
+# algorithm (`blake2b:<hexdigest>`), so that a database can mix both.
+
+HASH_ALGORITHMS = sorted(name for name in hashlib.algorithms_guaranteed
+                         if not name.startswith("shake_")) # no fixed length
+
+def digest_algorithm(digest):
+    algorithm, sep, _ = digest.partition(":")
+    
+    return algorithm if sep else "md5"
+
+def format_digest(algorithm, hexdigest):
+    return hexdigest if algorithm == "md5" else "{}:{}".format(algorithm, hexdigest)
+
+_buffers = threading.local() # one reusable buffer per hashing thread
+
+def get_buffer(size):
+    buf = getattr(_buffers, "buf", None)
+    if buf is None or len(buf) != size:
+        buf = _buffers.buf = bytearray(size)
+    return buf
+
+def fadvise(fd, advice, length=0):
+    # page cache hint, if the platform has it
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    try:
+        os.posix_fadvise(fd, 0, length, advice)
+    except OSError:
+        pass # only a hint
+
+def readahead(fullpath, cache=None, st=None, algorithm="md5"):
+    # starts reading the file into the page cache, to be hashed next,
+    # unless its checksum is in the cache
+    if not config.READAHEAD or not hasattr(os, "POSIX_FADV_WILLNEED"):
+        return
+
+    try:
+        if cache is not None and cache.get(st or os.stat(fullpath), algorithm):
+            return
+
+        fd = os.open(fullpath, os.O_RDONLY)
+        try:
+            fadvise(fd, os.POSIX_FADV_WILLNEED, config.READAHEAD_SIZE)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass # reported when hashed
+
+def hash_file(fname, algorithm, buffer_size, mmap_size=None):
+    # files of mmap_size bytes or more are hashed through mmap
+    hashval = hashlib.new(algorithm)
+
+    with profiling.phase("hash", files=1) as timer, open(fname, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        timer.add(nbytes=size)
+
+        if config.READAHEAD and hasattr(os, "POSIX_FADV_SEQUENTIAL"):
+            fadvise(f.fileno(), os.POSIX_FADV_SEQUENTIAL)
         
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hashval.update(chunk)
+        if mmap_size is not None and size and size >= mmap_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as f_map:
+                hashval.update(f_map)
+        else:
+            buf = get_buffer(buffer_size)
+            view = memoryview(buf)
+            while True:
+                nb_read = f.readinto(buf)
+                if not nb_read:
+                    break
+                hashval.update(view[:nb_read])
+
+        # read once: don't evict the cache of the other programs with it
+        if config.HASH_DROP_CACHE and hasattr(os, "POSIX_FADV_DONTNEED"):
+            fadvise(f.fileno(), os.POSIX_FADV_DONTNEED)
             
     return hashval.hexdigest()
 
+def fingerprint(fname, size):
+    # md5 of the size and of samples at the beginning, the middle
+    # and the end of the file: a change of content is very likely
+    # to change one of the samples (or the size).
+    sample_size = config.FINGERPRINT_SAMPLE_SIZE
+    
+    hashval = hashlib.md5(str(size).encode())
+    
+    with profiling.phase("fingerprint", files=1) as timer, open(fname, "rb", buffering=0) as f:
+        if size <= 3 * sample_size:
+            offsets = [0]
+            sample_size = size
+        else:
+            offsets = [0, (size - sample_size) // 2, size - sample_size]
+        timer.add(nbytes=len(offsets) * sample_size)
+            
+        for offset in offsets:
+            hashval.update(os.pread(f.fileno(), sample_size, offset))
+
+    return hashval.hexdigest()
+
+def checksum(fname, algorithm="md5"):
+    return format_digest(algorithm, hash_file(fname, algorithm,
+                                              config.HASH_BUFFER_SIZE,
+                                              config.HASH_MMAP_SIZE))
+
 
 class Repository():
     def __init__(self, name):
@@ -82,6 +363,7 @@ class Repository():
         
         self.copies_file = os.path.join(self.cfg_dir, config.COPIES_FILENAME)
         self.db_file = os.path.join(self.cfg_dir, config.DB_FILENAME)
+        self.sqlite_db_file = os.path.join(self.cfg_dir, config.SQLITE_DB_FILENAME)
         
         self.copyname = None
         self.tmp_dir = None
@@ -91,6 +373,15 @@ class Repository():
         self.DIFFERENT_FILES = None
         self.GOOD_FILES = None
         self.MOVED_FILES = None
+        self.STATUS_PARTIAL = None
+        self.STATUS_META = None
+        self.HASH_CACHE = None
+        self.TREAT_JOURNAL = None
+        self.WATCH_STATE = None
+        self.WATCH_DIRTY = None
+        self.WATCH_BASELINE = None
+        self.DIRS_STATE = None
+        self.DUPLICATES = None
         
     def set_copyname(self, copyname):
         self.copyname = copyname
@@ -101,6 +392,16 @@ class Repository():
         self.DIFFERENT_FILES = self.get_status_fname(config.DIFFERENT_FILES)
         self.GOOD_FILES      = self.get_status_fname(config.GOOD_FILES)
         self.MOVED_FILES     = self.get_status_fname(config.MOVED_FILES)
+        self.STATUS_PARTIAL  = os.path.join(self.tmp_dir, config.STATUS_PARTIAL_FILENAME)
+        self.STATUS_META     = os.path.join(self.tmp_dir, config.STATUS_META_FILENAME)
+
+        self.HASH_CACHE = os.path.join(self.tmp_dir, config.HASH_CACHE_FILENAME)
+        self.TREAT_JOURNAL = os.path.join(self.tmp_dir, config.TREAT_JOURNAL_FILENAME)
+        self.WATCH_STATE = os.path.join(self.tmp_dir, config.WATCH_STATE_FILENAME)
+        self.WATCH_DIRTY = os.path.join(self.tmp_dir, config.WATCH_DIRTY_FILENAME)
+        self.WATCH_BASELINE = os.path.join(self.tmp_dir, config.WATCH_BASELINE_FILENAME)
+        self.DIRS_STATE = os.path.join(self.tmp_dir, config.DIRS_STATE_FILENAME)
+        self.DUPLICATES = os.path.join(self.tmp_dir, config.DUPLICATES_FILENAME)
 
     def get_status_fname(self, fname):
         assert fname in config.STATUS_FILES_DESC
@@ -108,6 +409,7 @@ class Repository():
         return os.path.join(self.tmp_dir, fname)
     
     def get_copies(self, allow_new=False):
+        import yaml # slow to import, not needed when the index is used
         try:
             with open(self.copies_file) as copies_f:
                 return yaml.load(copies_f)
@@ -121,9 +423,14 @@ class Repository():
         return {}
         
     def write_copies(self, copies):
+        import yaml
         with open(self.copies_file, "w+") as copies_f:
             copies_f.write(yaml.dump(copies, default_flow_style=True))
 
+        # the index may not see a change within the same mtime tick
+        try: os.remove(os.path.join(config.CONFIG_PATH, config.REPO_INDEX_FILENAME))
+        except FileNotFoundError: pass
+
 def all_repositories():
     for filename in os.listdir(config.CONFIG_PATH):
         full_path = os.path.join(config.CONFIG_PATH, filename)
@@ -132,18 +439,55 @@ def all_repositories():
 
         yield filename, full_path
 
-def get_repo(fs_dir):
+# Index of the copies of all the repositories (REPO_INDEX_FILENAME), to
+# find the repository of a directory without parsing every copies file:
+#   {"copies": {<repository>: [st_mtime_ns, st_size] of its copies file},
+#    "dirs": {<directory>: [<repository>, <copy>]}}
+# rebuilt when a copies file is added, removed or modified.
+
+def copies_files_stat():
+    stats = OrderedDict()
     for reponame, repopath in all_repositories():
-        repo = Repository(reponame)
+        try:
+            st = os.stat(os.path.join(repopath, config.COPIES_FILENAME))
+        except FileNotFoundError:
+            continue
+        stats[reponame] = [st.st_mtime_ns, st.st_size]
+    return stats
 
-        for copyname, dirname in repo.get_copies().items():
-            if dirname != fs_dir:
-                continue
+def repo_index():
+    index_file = os.path.join(config.CONFIG_PATH, config.REPO_INDEX_FILENAME)
+    stats = copies_files_stat()
 
-            repo.set_copyname(copyname)
-            return repo
-        
-    # no repo found
-    return None
+    try:
+        with open(index_file) as index_f:
+            index = json.load(index_f)
+        if index["copies"] == stats:
+            return index["dirs"]
+    except (FileNotFoundError, ValueError, KeyError):
+        pass # rebuilt
+
+    dirs = {}
+    for reponame in stats:
+        for copyname, dirname in Repository(reponame).get_copies().items():
+            # first repository found, like before the index
+            dirs.setdefault(dirname, [reponame, copyname])
+
+    tmp_index_file = "{}.{}.tmp".format(index_file, os.getpid())
+    with open(tmp_index_file, "w") as index_f:
+        json.dump({"copies": stats, "dirs": dirs}, index_f)
+    os.replace(tmp_index_file, index_file)
+
+    return dirs
+
+def get_repo(fs_dir):
+    try:
+        reponame, copyname = repo_index()[fs_dir]
+    except KeyError:
+        return None # no repo found
+
+    repo = Repository(reponame)
+    repo.set_copyname(copyname)
+    return repo
 
     
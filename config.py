@@ -3,10 +3,55 @@ from collections import OrderedDict
 
 CONFIG_PATH = os.path.join(os.path.expanduser("~"), ".config", "backup.py")
 DB_FILENAME = "db.txt"
+SQLITE_DB_FILENAME = "db.sqlite"
+# backend of the databases created by `init`: "text" or "sqlite"
+DB_BACKEND = "text"
+# read the text database through mmap
+DB_MMAP = False
+DB_READ_SIZE = 1024*1024
 COPIES_FILENAME = "copies"
+# in CONFIG_PATH, directory -> (repository, copy) of all the copies files
+REPO_INDEX_FILENAME = "repositories.json"
 
 TO_IGNORE = [".git", "Other", "tmp", "VIDEO"]
 
+# checksum algorithm of the new repositories (init --algorithm)
+HASH_ALGORITHM = "md5"
+# files are read by chunks of that size ...
+HASH_BUFFER_SIZE = 1024*1024
+# ... or through mmap above that size (None to disable)
+HASH_MMAP_SIZE = 64*1024*1024
+
+# size of the 3 samples hashed for the fingerprint of a file (--fingerprint)
+FINGERPRINT_SAMPLE_SIZE = 64*1024
+
+# number of files hashed concurrently (--jobs)
+HASH_JOBS = 1
+# entries in flight per job, bounds the reorder window
+HASH_WINDOW = 16
+
+# files checked concurrently by `status verify` (only stat'ed, not read),
+# without --jobs
+VERIFY_JOBS = 16
+
+# order of the reads of the files: "inode", "extent" (FIEMAP) or None
+# for the walk order (see scheduler.py)
+READ_ORDER = "inode"
+# entries reordered together, the results are delayed by as much
+READ_SCHEDULE_WINDOW = 1024
+
+# page cache hints (posix_fadvise) of the files hashed: the next files
+# are read ahead (up to READAHEAD_SIZE bytes) while the current ones are
+# hashed, and dropped from the cache once hashed (HASH_DROP_CACHE)
+READAHEAD = True
+READAHEAD_SIZE = 16*1024*1024
+HASH_DROP_CACHE = True
+
+# per-copy cache of the checksums, keyed by file stat (in the copy tmp dir)
+HASH_CACHE_FILENAME = "hashes.txt"
+# the cache is compacted when it has that many times more lines than live entries
+HASH_CACHE_SLACK = 2
+
 NEW_FILES = "new.txt"
 MISSING_FILES = "missing.txt"
 DIFFERENT_FILES = "different.txt"
@@ -22,4 +67,51 @@ STATUS_FILES_DESC = OrderedDict(((GOOD_FILES, "Good files"),
                                 (NEW_FILES, "New files"),
                                 ))
 
+# content of good.txt: "full" (like the other status files), "compact"
+# (only the paths) or "count" (only the number of good files)
+GOOD_FILES_MODE = "full"
+
+# exists while the status files are written: the scan didn't complete
+STATUS_PARTIAL_FILENAME = "status.partial"
+
+# how the status files were computed, and when (see status.save_meta)
+STATUS_META_FILENAME = "status.meta"
+# `update` uses the status files younger than this (seconds) instead of
+# scanning the copy again
+STATUS_MAX_AGE = 24*60*60
+
+# entries added out of order (new, moved files...) sorted in memory by
+# `update` before being spilled to a temporary file (text database)
+UPDATE_SORT_ENTRIES = 100000
+
+# files copied concurrently by `treat` (--jobs)
+TRANSFER_JOBS = 4
+# copies are written to <file><suffix>, then renamed once complete
+TRANSFER_SUFFIX = ".backup-part"
+TRANSFER_CHUNK_SIZE = 64*1024*1024
+# try copy-on-write clones (btrfs, xfs) first
+TRANSFER_REFLINK = True
+# operations of `treat`, kept until they are all done (in the copy tmp dir)
+TREAT_JOURNAL_FILENAME = "treat-journal.txt"
+
+# `watch` files, in the copy tmp dir: watcher pid/token, changed
+# directories, and what the last complete scan saw (see watch.py)
+WATCH_STATE_FILENAME = "watch.state"
+WATCH_DIRTY_FILENAME = "watch-dirty.txt"
+WATCH_BASELINE_FILENAME = "watch-baseline.json"
+WATCH_READ_SIZE = 64*1024
+
+# mtime of the directories at the last complete scan, for `status --quick`
+DIRS_STATE_FILENAME = "dirs.txt"
+
+# duplicated files found by `dedup --write`, in the copy tmp dir
+DUPLICATES_FILENAME = "duplicates.txt"
+
+# seconds between two refreshes of the progress line
+PROGRESS_REFRESH = 0.5
+
 NOP = False
+
+# double-check new files with `grep` in the text database
+# (one process and one full database scan per new file)
+DEBUG_SLOW_CHECKS = False
@@ -0,0 +1,152 @@
+import os
+from collections import OrderedDict
+
+import common, hashcache, storage
+
+import logging; log = logging.getLogger('backup.dedup')
+
+# Files of the copy with the same content, found in stages, each one
+# reading more of the files, and only the files still candidates:
+#   size -- from the walk of the filesystem,
+#   sample -- fingerprint of the files (see common.fingerprint), skipped
+#             if all the files of the size have a checksum in the database,
+#   full hash -- from the database if the entry has the same size, or
+#                computed (and cached, like with `status --checksum`).
+# Hard links to the same file and empty files are ignored.
+# `dedup --write` writes the duplicates in DUPLICATES_FILENAME (in the
+# copy tmp dir), like the status files:
+#   <relpath> -> md5sum: <md5>, size: <size>, duplicate_of: <relpath of the kept file>
+
+def do_dedup(args):
+    fs_dir = os.path.abspath(".")
+
+    repo = common.get_repo(fs_dir)
+    if not repo:
+        log.critical("Could not find a repository with {} in copies...".format(fs_dir))
+        return
+
+    try: os.mkdir(repo.tmp_dir)
+    except FileExistsError: pass # ignore
+
+    database = storage.open_database(repo)
+    with hashcache.HashCache(repo.HASH_CACHE) as cache:
+        groups = find_duplicates(fs_dir, database, common.get_jobs(args), cache)
+
+    print_duplicates(groups)
+
+    if args["--write"]:
+        write_duplicates(repo, groups)
+
+def find_duplicates(fs_dir, database, jobs=1, cache=None):
+    # returns the groups of files with the same content, as (checksum,
+    # [(fullpath, relpath, stat, database info or None)])
+    by_size = OrderedDict()
+    inodes = set()
+    nb_files = 0
+    for entry in common.walk_filesystem(fs_dir):
+        if not entry:
+            continue
+
+        fullpath, relpath, dir_entry = entry
+        if dir_entry.is_symlink():
+            continue
+
+        st = dir_entry.stat()
+        if not st.st_size or (st.st_dev, st.st_ino) in inodes:
+            continue
+
+        inodes.add((st.st_dev, st.st_ino))
+        by_size.setdefault(st.st_size, []).append((fullpath, relpath, st))
+        nb_files += 1
+
+    groups = [files for files in by_size.values() if len(files) > 1]
+    log.info("{} files, {} with the size of another one.".format(nb_files, sum(map(len, groups))))
+
+    # database lookups in this thread (SQLite connections can't be shared)
+    def with_db_info(fullpath, relpath, st):
+        db_info = database.get(relpath)
+        if db_info is not None and int(db_info["size"]) != st.st_size:
+            db_info = None # modified since the last update
+
+        return fullpath, relpath, st, db_info
+
+    groups = [[with_db_info(*a_file) for a_file in files] for files in groups]
+
+    def has_digest(a_file):
+        db_info = a_file[3]
+        return db_info is not None and common.digest_algorithm(db_info["md5sum"]) == database.algorithm
+
+    def sample(a_file):
+        fullpath, relpath, st, db_info = a_file
+        if db_info is not None and "fingerprint" in db_info:
+            return db_info["fingerprint"]
+
+        return common.fingerprint(fullpath, st.st_size)
+
+    def digest(a_file):
+        fullpath, relpath, st, db_info = a_file
+        if has_digest(a_file):
+            return db_info["md5sum"]
+
+        return common.get_file_info(fullpath, True, cache, st, database.algorithm)["md5sum"]
+
+    known = [files for files in groups if all(map(has_digest, files))]
+    sampled = [files for fprint, files in split_groups(
+            [files for files in groups if not all(map(has_digest, files))], sample, jobs)]
+    log.info("{} files with the same sample as another one.".format(sum(map(len, sampled))))
+
+    groups = split_groups(known + sampled, digest, jobs)
+    log.info("{} files with the same checksum as another one.".format(
+            sum(len(files) for md5sum, files in groups)))
+
+    return groups
+
+def split_groups(groups, key, jobs=1):
+    # splits the groups by key(file), computed concurrently, and drops the
+    # files left alone. Returns (key, group), the files keep their order.
+    files = [(group_id, a_file) for group_id, group in enumerate(groups) for a_file in group]
+
+    keys = common.ordered_map(lambda group_file: key(group_file[1]), files, jobs)
+
+    new_groups = OrderedDict()
+    for (group_id, a_file), file_key in zip(files, keys):
+        new_groups.setdefault((group_id, file_key), []).append(a_file)
+
+    return [(file_key, group) for (group_id, file_key), group in new_groups.items()
+            if len(group) > 1]
+
+def kept_file(group):
+    # the first file already in the database, or the first one
+    return next((a_file for a_file in group if a_file[3] is not None), group[0])
+
+def reclaimable(group):
+    return (len(group) - 1) * group[0][2].st_size
+
+def print_duplicates(groups):
+    groups = sorted((group for md5sum, group in groups), key=reclaimable, reverse=True)
+
+    for group in groups:
+        log.warn("{} files of {} bytes:".format(len(group), group[0][2].st_size))
+
+        kept = kept_file(group)
+        for a_file in group:
+            log.info("  {}{}".format(a_file[1], "" if a_file is not kept else " (kept)"))
+
+    log.warn("{} groups of duplicates, {} files, {:.1f} MB reclaimable.".format(
+            len(groups), sum(len(group) - 1 for group in groups),
+            sum(map(reclaimable, groups)) / (1024*1024)))
+
+def write_duplicates(repo, groups):
+    with open(repo.DUPLICATES, "w") as dup_f:
+        for md5sum, group in groups:
+            kept = kept_file(group)
+            for fullpath, relpath, st, db_info in group:
+                if relpath == kept[1]:
+                    continue
+
+                info = OrderedDict((("md5sum", md5sum),
+                                    ("size", str(st.st_size)),
+                                    ("duplicate_of", kept[1])))
+                common.print_a_file(relpath, info, dup_f)
+
+    log.info("Duplicates written in {}.".format(repo.DUPLICATES))
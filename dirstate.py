@@ -0,0 +1,132 @@
+import os
+from collections import OrderedDict
+
+import common, config, storage
+
+import logging; log = logging.getLogger('backup.dirstate')
+
+# State of the directories of a copy after its last complete scan
+# (DIRS_STATE_FILENAME, in the copy tmp dir):
+#   #backup.py checksum: True, fingerprint: False
+#   <dirpath> -> mtime: <st_mtime_ns>, own: <own hash of the directory in the database>
+# only for the directories whose files were all good. `status --quick`
+# then only scans the directories whose mtime or database summary
+# changed: adding, removing or renaming a file changes the mtime of its
+# directory, rewriting it in place doesn't.
+
+def snapshot(fs_dir, summaries):
+    # to call before a complete scan: a directory changed during the
+    # scan has another mtime afterwards, so it is scanned next time.
+    mtimes = {}
+    for dirpath in summaries:
+        try:
+            mtimes[dirpath] = os.stat(os.path.join(fs_dir, dirpath)).st_mtime_ns
+        except OSError:
+            pass # missing
+    return mtimes
+
+def save(repo, mtimes, summaries, changed_dirs, do_checksum, do_fingerprint):
+    # changed_dirs: directories with files not good
+    dirty = set(changed_dirs)
+    for dirpath in list(dirty):
+        # new directories are found by listing their closest known parent
+        while dirpath and dirpath not in summaries:
+            dirpath = storage.parent_dir(dirpath)
+            dirty.add(dirpath)
+
+    tmp_state_file = "{}.tmp".format(repo.DIRS_STATE)
+    with open(tmp_state_file, "w") as state_f:
+        print(common.format_db_header(OrderedDict((("checksum", bool(do_checksum)),
+                                                   ("fingerprint", bool(do_fingerprint))))),
+              file=state_f)
+
+        for dirpath, mtime in mtimes.items():
+            if dirpath in dirty or dirpath not in summaries:
+                continue
+
+            common.print_a_file(dirpath, OrderedDict((("mtime", mtime),
+                                                      ("own", summaries[dirpath]["own"]))), state_f)
+
+    os.replace(tmp_state_file, repo.DIRS_STATE)
+
+def load(repo):
+    # returns (header, {dirpath: (mtime, own)}), or None
+    try:
+        with open(repo.DIRS_STATE) as state_f:
+            header = common.parse_db_header(state_f.readline())
+
+            states = {}
+            for line in state_f:
+                dirpath, _, info_str = line[:-1].partition(" -> ")
+                info = common.parse_info(info_str)
+                states[dirpath] = int(info["mtime"]), info["own"]
+    except FileNotFoundError:
+        return None
+
+    return header, states
+
+def quick_dirty(repo, fs_dir, database, do_checksum, do_fingerprint):
+    # returns (dirty dirs, dirty trees) like watch.dirty_set, or None if
+    # the whole copy must be scanned
+    loaded = load(repo)
+    if loaded is None:
+        log.info("Full scan: no complete scan of this copy yet.")
+        return None
+
+    header, states = loaded
+    if (do_checksum and header.get("checksum") != "True") \
+            or (do_fingerprint and header.get("fingerprint") != "True"):
+        log.info("Full scan: the last complete scan didn't use --checksum/--fingerprint.")
+        return None
+
+    summaries = database.dir_summaries()
+
+    children = {}
+    for dirpath in summaries:
+        if dirpath:
+            children.setdefault(storage.parent_dir(dirpath), []).append(dirpath)
+
+    ignored = set(config.TO_IGNORE)
+    dirty_dirs, dirty_trees = set(), set()
+    nb_dirs = 0
+
+    to_visit = [""]
+    while to_visit:
+        dirpath = to_visit.pop()
+        fullpath = os.path.join(fs_dir, dirpath) if dirpath else fs_dir
+
+        try:
+            mtime = os.stat(fullpath).st_mtime_ns
+        except FileNotFoundError:
+            dirty_trees.add(dirpath) # its entries are missing
+            continue
+        nb_dirs += 1
+
+        summary = summaries.get(dirpath)
+        if states.get(dirpath) == (mtime, summary and summary["own"]):
+            # same files as when it was good, same subdirectories
+            to_visit += children.get(dirpath, [])
+            continue
+
+        dirty_dirs.add(dirpath)
+
+        # the subdirectories may have changed too
+        known = set(children.get(dirpath, []))
+        with os.scandir(fullpath) as dir_it:
+            for entry in dir_it:
+                if not entry.is_dir(follow_symlinks=False) or entry.name in ignored:
+                    continue
+
+                subdir = "{}/{}".format(dirpath, entry.name) if dirpath else entry.name
+                if subdir in known:
+                    known.remove(subdir)
+                    to_visit.append(subdir)
+                else:
+                    dirty_trees.add(subdir) # new
+
+        dirty_trees.update(known) # removed
+
+    log.info("Quick scan: {} directories checked, {} changed ({} trees).".format(
+            nb_dirs, len(dirty_dirs), len(dirty_trees)))
+
+    return dirty_dirs, dirty_trees
@@ -0,0 +1,100 @@
+import os
+import threading
+
+import common, config
+
+import logging; log = logging.getLogger('backup.hashcache')
+
+# One line per hashed file and algorithm:
+#   <st_dev> <st_ino> <st_size> <st_mtime_ns> <st_ctime_ns> <checksum>
+# (the algorithm is the prefix of the checksum, see common.format_digest)
+# Lines are appended (and flushed) as soon as a checksum is computed,
+# so that an interrupted scan doesn't lose the work already done.
+
+def stat_key(st):
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+def cache_key(st, algorithm):
+    return stat_key(st) + (algorithm,)
+
+class HashCache():
+    def __init__(self, cache_file, rehash=False):
+        self.cache_file = cache_file
+        self.rehash = rehash
+
+        self.entries = {}
+        self.seen = set()
+        self.nb_lines = 0
+
+        self.lock = threading.Lock()
+        self.cache_f = None
+
+    def __enter__(self):
+        self.load()
+        self.cache_f = open(self.cache_file, "a", buffering=1) # line buffered
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.cache_f.close()
+        self.cache_f = None
+
+    def load(self):
+        try:
+            with open(self.cache_file) as cache_f:
+                for line in cache_f:
+                    self.nb_lines += 1
+                    try:
+                        *key, hashval = line.split()
+                        self.entries[tuple(map(int, key)) + (common.digest_algorithm(hashval),)] = hashval
+                    except ValueError:
+                        pass # interrupted line, ignore
+        except FileNotFoundError:
+            pass # no cache yet
+
+        log.debug("{} checksums in cache {}.".format(len(self.entries), self.cache_file))
+
+    def get(self, st, algorithm="md5"):
+        if self.rehash:
+            return None
+
+        key = cache_key(st, algorithm)
+        hashval = self.entries.get(key)
+
+        if hashval is not None:
+            self.seen.add(key)
+
+        return hashval
+
+    def put(self, st, hashval):
+        key = cache_key(st, common.digest_algorithm(hashval))
+
+        with self.lock:
+            self.entries[key] = hashval
+            self.seen.add(key)
+
+            print(" ".join(map(str, key[:-1] + (hashval,))), file=self.cache_f)
+            self.nb_lines += 1
+
+    def compact(self):
+        # only call after a complete checksum scan:
+        # the files not seen during the scan are dropped.
+        if self.nb_lines <= len(self.seen) * config.HASH_CACHE_SLACK:
+            return
+
+        with self.lock:
+            self._rewrite()
+
+    def _rewrite(self):
+        tmp_cache_file = "{}.tmp".format(self.cache_file)
+        with open(tmp_cache_file, "w") as tmp_cache_f:
+            for key in self.seen:
+                print(" ".join(map(str, key[:-1] + (self.entries[key],))), file=tmp_cache_f)
+
+        os.replace(tmp_cache_file, self.cache_file)
+
+        if self.cache_f is not None:
+            self.cache_f.close()
+            self.cache_f = open(self.cache_file, "a", buffering=1)
+
+        log.debug("Cache {} compacted: {} -> {} lines.".format(self.cache_file, self.nb_lines, len(self.seen)))
+        self.nb_lines = len(self.seen)
@@ -1,6 +1,6 @@
 import os
 
-import config, common
+import config, common, storage
 
 import logging; log = logging.getLogger('backup.init')
 
@@ -16,13 +16,16 @@ def do_info(args):
     log.info("Repository:  {} ({})".format(repo.name, repo.copyname))
     log.info("Copies:".format(repo.copyname, fs_dir))
 
-    max_size = max(map(len, repo.get_copies()))
-    for copy, dirname in repo.get_copies().items():
+    copies = repo.get_copies()
+    max_size = max(map(len, copies))
+    for copy, dirname in copies.items():
         log.info("  {}{}--> {}".format(copy,
                                        (max_size-len(copy)+1)*" ",
                                        dirname))
         
     log.info("")
+    database = storage.open_database(repo)
+    log.info("Database: {} ({} backend)".format(database.path, database.name))
     log.info("Temporary dir: {}".format(repo.tmp_dir))
     log.info("")
     log.info("Status files:")
@@ -3,19 +3,27 @@ import yaml
 
 import config
 import common
+import hashcache
+import storage
 
 import logging; log = logging.getLogger('backup.init')
 
 def do_init(args):
     if not args["from"]:
-        init_repository(args["<name>"], args["--force"])
+        init_repository(args["<name>"], args["--force"], common.get_jobs(args), args["--rehash"],
+                        args["--algorithm"] or config.HASH_ALGORITHM)
     else:
         init_from_repository(args["<name>"], args["<backup-name>"], args["--force"])
 
 
-def init_repository(name, force=False):
+def init_repository(name, force=False, jobs=1, rehash=False, algorithm="md5"):
     fs_dir = os.path.abspath(".")
 
+    if algorithm not in common.HASH_ALGORITHMS:
+        log.critical("Unknown checksum algorithm '{}', choose one of {}.".format(
+                algorithm, ", ".join(common.HASH_ALGORITHMS)))
+        return
+
     repo = common.Repository(name)
     
     ###
@@ -28,8 +36,9 @@ def init_repository(name, force=False):
 
     # check first if the database exists
     
-    if not force and os.path.exists(repo.db_file):
-        log.critical("Database file '{}' already exists. ".format(repo.db_file))
+    database = storage.open_database(repo)
+    if not force and database.exists():
+        log.critical("Database file '{}' already exists. ".format(database.path))
         log.warn("Delete it first to (re)create the database.")
         return
     
@@ -55,18 +64,27 @@ def init_repository(name, force=False):
     # create database
     ###
 
-    log.info("Initializing {} database into {}.".format(name, repo.db_file))
+    previous_database = database
+    database = storage.new_database(repo, config.DB_BACKEND, algorithm)
+    log.info("Initializing {} database into {}.".format(name, database.path))
 
     if not config.NOP:
+        if previous_database.exists() and previous_database.name != database.name:
+            previous_database.remove() # --force with another backend
+        
         try:
-            with open(repo.db_file, "w+") as db_f:
-                common.print_filesystem(fs_dir, out_f=db_f)
+            with hashcache.HashCache(repo.HASH_CACHE, rehash) as cache:
+                database.write(entry[1:] for entry
+                               in common.browse_filesystem(fs_dir, True, jobs, cache, algorithm)
+                               if entry)
+                cache.compact()
         except Exception as e:
             log.critical("Database generation failed: {}".format(e))
-            os.remove(repo.db_file)
+            if database.exists():
+                database.remove()
             raise e
     else:
-        log.critical("NOP: print_filesystem({}, {})".format(repo.fs_dir, repo.db_file))
+        log.critical("NOP: write_database({}, {})".format(fs_dir, database.path))
         
     log.info("Database for {} correctly initialized.".format(name))
     
@@ -79,8 +97,9 @@ def init_from_repository(src, name, force=False):
         log.error("Config dir '{}' doesn't exists.".format(repo.cfg_dir))
         return
 
-    if not os.path.exists(repo.db_file):
-        log.error("Database file '{}' doesn't exists.".format(repo.db_file))
+    database = storage.open_database(repo)
+    if not database.exists():
+        log.error("Database file '{}' doesn't exists.".format(database.path))
         return
 
     if not os.path.exists(repo.copies_file):
@@ -0,0 +1,163 @@
+import os
+import json
+import threading
+from collections import OrderedDict, namedtuple
+
+import config, transfer
+
+import logging; log = logging.getLogger('backup.journal')
+
+# One JSON object per line, appended (and flushed) as `treat` progresses:
+#   {"id": 3, "state": "planned", "action": "copy", "src": ..., "dst": ..., "expected": ...}
+#   {"id": 3, "state": "started"}
+#   {"id": 3, "state": "done"}   (or "failed", with the error)
+# Operations not done are run again by `treat resume`. The journal is
+# removed once all of its operations are done.
+
+Move = namedtuple("Move", ("src", "dst"))
+Delete = namedtuple("Delete", ("path",))
+
+ACTIONS = OrderedDict((("move", Move), ("delete", Delete), ("copy", transfer.Transfer)))
+ACTION_NAMES = {action_type: name for name, action_type in ACTIONS.items()}
+
+class Journal():
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+
+        self.operations = OrderedDict() # id -> operation
+        self.states = {}
+        self.ids = {}
+
+        self.lock = threading.Lock()
+        self.journal_f = None
+
+    def __enter__(self):
+        self.load()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.journal_f is not None:
+            self.journal_f.close()
+            self.journal_f = None
+
+        if exc_type is None and self.operations and not self.pending() \
+                and os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+
+    def exists(self):
+        return os.path.exists(self.journal_file)
+
+    def load(self):
+        try:
+            with open(self.journal_file) as journal_f:
+                for line in journal_f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # interrupted line, ignore
+
+                    op_id = entry.pop("id")
+                    state = entry.pop("state")
+                    if state == "planned":
+                        operation = ACTIONS[entry.pop("action")](**entry)
+                        self.operations[op_id] = operation
+                        self.ids[operation] = op_id
+
+                    self.states[op_id] = state
+        except FileNotFoundError:
+            pass # nothing to resume
+
+    def write(self, entry):
+        if config.NOP: return
+
+        with self.lock:
+            if self.journal_f is None:
+                self.journal_f = open(self.journal_file, "a", buffering=1) # line buffered
+
+            print(json.dumps(entry), file=self.journal_f)
+
+    def plan(self, operations):
+        next_id = max(self.operations, default=0) + 1
+
+        for op_id, operation in enumerate(operations, next_id):
+            if operation in self.ids:
+                continue # already planned
+
+            self.operations[op_id] = operation
+            self.ids[operation] = op_id
+            self.states[op_id] = "planned"
+
+            entry = OrderedDict((("id", op_id), ("state", "planned"),
+                                 ("action", ACTION_NAMES[type(operation)])))
+            entry.update(operation._asdict())
+            self.write(entry)
+
+    def mark(self, operation, state, error=None):
+        op_id = self.ids[operation]
+        self.states[op_id] = state
+
+        entry = OrderedDict((("id", op_id), ("state", state)))
+        if error is not None:
+            entry["error"] = str(error)
+        self.write(entry)
+
+    def pending(self):
+        return [operation for op_id, operation in self.operations.items()
+                if self.states[op_id] != "done"]
+
+    def summary(self):
+        counts = OrderedDict()
+        for state in self.states.values():
+            counts[state] = counts.get(state, 0) + 1
+
+        return ", ".join("{} {}".format(count, state) for state, count in counts.items())
+
+    def run(self, jobs=1):
+        # returns the operations that failed
+        pending = self.pending()
+        failed = []
+
+        for operation in pending:
+            if isinstance(operation, transfer.Transfer):
+                continue
+
+            if config.NOP:
+                log.critical("NOP: {}".format(operation))
+                continue
+
+            self.mark(operation, "started")
+            try:
+                if isinstance(operation, Move):
+                    move_file(operation)
+                else:
+                    delete_file(operation)
+            except OSError as e:
+                log.error("{} failed: {}".format(operation, e))
+                self.mark(operation, "failed", e)
+                failed.append(operation)
+                continue
+
+            self.mark(operation, "done")
+
+        transfers = [operation for operation in pending if isinstance(operation, transfer.Transfer)]
+        failed += transfer.run_transfers(transfers, jobs, self)
+
+        if failed:
+            log.error("{} operations failed, run `treat resume` to retry them.".format(len(failed)))
+
+        return failed
+
+def move_file(move):
+    if not os.path.lexists(move.src) and os.path.lexists(move.dst):
+        return # moved before the interruption
+
+    transfer.move_file(move.src, move.dst)
+
+def delete_file(delete):
+    if not os.path.lexists(delete.path):
+        return # deleted before the interruption
+
+    os.remove(delete.path)
+
+    try: os.rmdir(os.path.dirname(delete.path))
+    except OSError: pass # ignore, not empty
@@ -0,0 +1,130 @@
+import sys, time
+import threading
+from collections import OrderedDict
+
+import logging; log = logging.getLogger('backup.profiling')
+
+# Timers and counters of the phases of a command, enabled by `--profile`.
+#   with profiling.phase("hash", files=1) as timer: ... timer.add(nbytes=size)
+#   for entry in profiling.timed_iter("db read", database.browse()): ...
+# The phases can be nested: the `self` time of a phase excludes the time
+# of the phases started inside it, on the same thread. Phases run by
+# workers (hash...) are summed over the threads, their time can be
+# longer than the wall time.
+
+enabled = False
+
+class Stats():
+    __slots__ = ("calls", "total", "self", "files", "bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = self.self = 0.0
+        self.files = self.bytes = 0
+
+stats = OrderedDict()
+lock = threading.Lock()
+local = threading.local()
+
+def get_stats(name):
+    try:
+        return stats[name]
+    except KeyError:
+        with lock:
+            return stats.setdefault(name, Stats())
+
+def count(name, files=0, nbytes=0):
+    if not enabled: return
+
+    phase_stats = get_stats(name)
+    with lock:
+        phase_stats.calls += 1
+        phase_stats.files += files
+        phase_stats.bytes += nbytes
+
+class Phase():
+    __slots__ = ("name", "files", "nbytes", "start", "children")
+
+    def __init__(self, name, files, nbytes):
+        self.name = name
+        self.files = files
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        try:
+            local.stack.append(self)
+        except AttributeError:
+            local.stack = [self]
+
+        self.children = 0.0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        elapsed = time.perf_counter() - self.start
+
+        stack = local.stack
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+
+        phase_stats = get_stats(self.name)
+        with lock:
+            phase_stats.calls += 1
+            phase_stats.total += elapsed
+            phase_stats.self += elapsed - self.children
+            phase_stats.files += self.files
+            phase_stats.bytes += self.nbytes
+
+    def add(self, files=0, nbytes=0):
+        self.files += files
+        self.nbytes += nbytes
+
+class NoPhase():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+    def add(self, files=0, nbytes=0):
+        pass
+
+NO_PHASE = NoPhase()
+
+def phase(name, files=0, nbytes=0):
+    if not enabled:
+        return NO_PHASE
+
+    return Phase(name, files, nbytes)
+
+def timed_iter(name, iterable):
+    # times each next() of `iterable`
+    if not enabled:
+        return iterable
+
+    return _timed_iter(name, iter(iterable))
+
+def _timed_iter(name, iterator):
+    while True:
+        with Phase(name, 0, 0) as timer:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+
+            if item: # not an end-of-directory/stream marker
+                timer.add(files=1)
+        yield item
+
+def report(out_f=sys.stderr):
+    if not stats:
+        return
+
+    print("{:20s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s}".format(
+            "phase", "calls", "total (s)", "self (s)", "files", "MB"), file=out_f)
+
+    for name, phase_stats in stats.items():
+        print("{:20s} {:10d} {:10.3f} {:10.3f} {:10d} {:10.1f}".format(
+                name, phase_stats.calls, phase_stats.total, phase_stats.self,
+                phase_stats.files, phase_stats.bytes / (1024*1024)), file=out_f)
@@ -0,0 +1,86 @@
+import sys, time
+
+import config
+
+# Progress line of long operations, in files and bytes:
+#   \r 42.10%  13503/32071 files  40960/97280 MB  112.3 MB/s  ETA 0:08:37
+# Redrawn at most every PROGRESS_REFRESH seconds, and only on a terminal.
+
+enabled = True
+
+class Progress():
+    def __init__(self, total_files, total_bytes=None, by_bytes=False, out_f=None):
+        # by_bytes: the completion (and the ETA) is computed from the bytes
+        # instead of the files, if total_bytes is known.
+        self.out_f = out_f or sys.stdout
+        self.enabled = enabled and self.out_f.isatty()
+
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.by_bytes = by_bytes and bool(total_bytes)
+
+        self.files = self.bytes = 0
+        self.start = time.monotonic()
+        self.next_refresh = self.start + config.PROGRESS_REFRESH
+        self.line_len = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def update(self, files=1, nbytes=0):
+        self.files += files
+        self.bytes += nbytes
+
+        if not self.enabled:
+            return
+
+        now = time.monotonic()
+        if now < self.next_refresh:
+            return
+
+        self.next_refresh = now + config.PROGRESS_REFRESH
+        self.render(now)
+
+    def fraction(self):
+        if self.by_bytes:
+            done, total = self.bytes, self.total_bytes
+        else:
+            done, total = self.files, self.total_files
+
+        return min(done / total, 1.0) if total else 1.0
+
+    def render(self, now):
+        elapsed = now - self.start
+        fraction = self.fraction()
+
+        parts = ["{:6.2f}%".format(fraction * 100),
+                 "{}/{} files".format(self.files, self.total_files)]
+
+        if self.total_bytes:
+            parts.append("{}/{} MB".format(self.bytes // (1024*1024), self.total_bytes // (1024*1024)))
+        if self.bytes and elapsed:
+            parts.append("{:.1f} MB/s".format(self.bytes / elapsed / (1024*1024)))
+        elif elapsed:
+            parts.append("{:.0f} files/s".format(self.files / elapsed))
+
+        if 0 < fraction < 1:
+            eta = int(elapsed * (1 - fraction) / fraction)
+            parts.append("ETA {}:{:02d}:{:02d}".format(eta // 3600, eta // 60 % 60, eta % 60))
+
+        line = "  ".join(parts)
+
+        # pad with spaces to erase the end of a longer previous line
+        print("\r" + line.ljust(self.line_len), end="", file=self.out_f, flush=True)
+        self.line_len = len(line)
+
+    def close(self):
+        if not self.enabled or self.out_f is None:
+            return
+
+        self.render(time.monotonic())
+        print("", file=self.out_f)
+
+        self.enabled = False
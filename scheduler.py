@@ -0,0 +1,162 @@
+import os
+import fcntl
+import struct
+import functools
+import itertools
+import concurrent.futures
+from collections import OrderedDict, deque
+
+import common, config
+
+import logging; log = logging.getLogger('backup.scheduler')
+
+# Order of the reads of the files (hashing, copies): the walk order of
+# the copy is a seek per file on a spinning disk. The pending reads are
+# submitted in the order of their position on the disk (READ_ORDER):
+#   "inode" -- by inode number, close to the allocation order on most
+#              filesystems (ext4, xfs), and free to get,
+#   "extent" -- by the physical offset of the first extent of the file
+#               (Linux FIEMAP ioctl), by inode if not supported,
+#   None -- in the walk order.
+# One queue per device (st_dev): the devices are read in turn, each in
+# its own order. The results are still yielded in the walk order.
+
+FS_IOC_FIEMAP = 0xC020660B # linux/fs.h, _IOWR('f', 11, struct fiemap)
+# struct fiemap: fm_start, fm_length, fm_flags, fm_mapped_extents,
+# fm_extent_count, fm_reserved, then the extents
+FIEMAP = struct.Struct("=QQLLLL")
+# struct fiemap_extent: fe_logical, fe_physical, fe_length, ...
+FIEMAP_EXTENT = struct.Struct("=QQQQQLLLL")
+
+@functools.lru_cache(maxsize=1024)
+def dir_device(dirpath):
+    return os.stat(dirpath).st_dev
+
+def first_extent(fd):
+    # physical offset of the first extent of the file, or None
+    buf = bytearray(FIEMAP.pack(0, 2**64 - 1, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT.size))
+    fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+
+    if not FIEMAP.unpack_from(buf)[3]:
+        return None # empty file, or data inlined in the inode
+
+    return FIEMAP_EXTENT.unpack_from(buf, FIEMAP.size)[1]
+
+def read_key(fullpath, dir_entry=None):
+    # returns (st_dev, position on the device) of the file, or None
+    try:
+        if config.READ_ORDER == "extent":
+            fd = os.open(fullpath, os.O_RDONLY)
+            try:
+                st = os.fstat(fd)
+                try:
+                    position = first_extent(fd)
+                except OSError:
+                    position = None # not supported by the filesystem
+            finally:
+                os.close(fd)
+
+            return st.st_dev, position if position is not None else st.st_ino
+
+        if dir_entry is not None:
+            # no stat: the inode number comes with the directory listing
+            return dir_device(os.path.dirname(fullpath)), dir_entry.inode()
+
+        st = os.stat(fullpath)
+        return st.st_dev, st.st_ino
+    except OSError:
+        return None # reported when read
+
+def entry_key(entry):
+    # key of the (fullpath, relpath, DirEntry) entries of common.walk_filesystem
+    fullpath, relpath, dir_entry = entry
+
+    return read_key(fullpath, dir_entry)
+
+def schedule(items, key):
+    # returns the items in their read order: sorted by position on each
+    # device, the devices in turn. The items without key are a queue of
+    # their own.
+    queues = OrderedDict()
+    for idx, item in enumerate(items):
+        item_key = key(item)
+        device, position = item_key if item_key is not None else (None, -1)
+
+        queues.setdefault(device, []).append((position, idx, item))
+
+    for queue in queues.values():
+        queue.sort(key=lambda queued: queued[:2])
+
+    return [queued[2] for queued_items in itertools.zip_longest(*queues.values())
+            for queued in queued_items if queued is not None]
+
+def scheduled_map(func, entries, jobs=1, key=entry_key, prefetch=None):
+    # like common.ordered_map, but the entries are submitted by windows of
+    # READ_SCHEDULE_WINDOW, each one in its read order (see schedule).
+    # None/False entries (end of dir/FS) are passed through untouched.
+    # At most jobs*HASH_WINDOW entries are in flight, the results are
+    # yielded in the walk order as soon as they are done.
+    # prefetch(entry) is called on the entry `jobs` places ahead in the
+    # read order, before func(entry): it is read while the current
+    # entries are processed (see common.readahead).
+    if not config.READ_ORDER and prefetch is None:
+        yield from common.ordered_map(func, entries, jobs)
+        return
+
+    jobs = max(jobs, 1)
+    def in_read_order(window):
+        indexed = [(idx, entry) for idx, entry in enumerate(window) if entry]
+        if not config.READ_ORDER:
+            return indexed
+
+        return schedule(indexed, lambda indexed_entry: key(indexed_entry[1]))
+
+    def run(result, ordered, position):
+        # result: Future of the entry, in the walk order
+        try:
+            if prefetch is not None and position + jobs < len(ordered):
+                prefetch(ordered[position + jobs][1])
+
+            result.set_result(func(ordered[position][1]))
+        except Exception as e:
+            result.set_exception(e)
+
+    pending = deque() # results in the walk order
+    in_flight = deque() # submitted to the workers
+    def done():
+        while pending and (not pending[0] or pending[0].done()):
+            yield common.resolve_entry(pending.popleft())
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    try:
+        for window in windows(entries, config.READ_SCHEDULE_WINDOW):
+            results = [concurrent.futures.Future() if entry else entry for entry in window]
+            pending.extend(results)
+
+            ordered = in_read_order(window)
+            for position, (idx, entry) in enumerate(ordered):
+                if executor is None:
+                    run(results[idx], ordered, position)
+                else:
+                    while len(in_flight) >= jobs * config.HASH_WINDOW or (in_flight and in_flight[0].done()):
+                        in_flight.popleft().result()
+                    in_flight.append(executor.submit(run, results[idx], ordered, position))
+
+                yield from done()
+
+        while pending:
+            yield common.resolve_entry(pending.popleft())
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+def windows(entries, size):
+    window = []
+    for entry in entries:
+        window.append(entry)
+        if len(window) >= size:
+            yield window
+            window = []
+
+    if window:
+        yield window
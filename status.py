@@ -1,6 +1,8 @@
 import os, time
+import json
+from concurrent.futures import ThreadPoolExecutor
 
-import common, config, verify
+import common, config, verify, hashcache, storage, profiling, progress, watch, dirstate
 from enum import Enum
 import logging; log = logging.getLogger('backup.status')
 from collections import OrderedDict
@@ -9,6 +11,8 @@ def do_status(args):
     fs_dir = os.path.abspath(".")
 
     do_checksum = args["--checksum"]
+    do_fingerprint = args["--fingerprint"]
+    do_quick = args["--quick"]
     
     repo = common.get_repo(fs_dir)
     if not repo:
@@ -23,7 +27,11 @@ def do_status(args):
             log.warn("No status file to clean for repository '{}'.".format(repo.name))
         
     elif args["verify"]:
-        verify.verify_all(repo, fs_dir)
+        verify.verify_all(repo, fs_dir, int(args["--jobs"]) if args["--jobs"] else None, args["--deep"])
+        
+    elif args["--all-copies"]:
+        status_all_copies(repo, do_checksum, common.get_jobs(args), args["--rehash"], do_fingerprint,
+                          do_quick, args["--force"])
         
     else:
         if has_status(repo) and not args["--force"]:
@@ -31,11 +39,11 @@ def do_status(args):
             log.info("(Run `status --force` to force rescan.)")
         else:
             do_clean(repo)
-            status(repo, fs_dir, do_checksum)
+            status(repo, fs_dir, do_checksum, common.get_jobs(args), args["--rehash"], do_fingerprint, do_quick)
 
 def do_clean(repo):
     cleaned = False
-    for to_remove in config.STATUS_FILES:
+    for to_remove in config.STATUS_FILES + (config.STATUS_PARTIAL_FILENAME, config.STATUS_META_FILENAME):
         try:
             path = os.path.join(repo.tmp_dir, to_remove)
             os.remove(path)
@@ -47,6 +55,9 @@ def do_clean(repo):
     return cleaned
             
 def has_status(repo):
+    if os.path.exists(repo.STATUS_PARTIAL):
+        return False
+    
     for fname in config.STATUS_FILES:
         fpath = os.path.join(repo.tmp_dir, fname)
         
@@ -54,7 +65,20 @@ def has_status(repo):
             return False
     return True
 
+def count_entries(fpath):
+    # good.txt may only have the count (GOOD_FILES_MODE)
+    with open(fpath) as status_f:
+        header = common.parse_db_header(status_f.readline())
+        if header and "good" in header:
+            return int(header["good"])
+        
+        status_f.seek(0)
+        return sum(1 for line in status_f)
+
 def do_show(repo):
+    if os.path.exists(repo.STATUS_PARTIAL):
+        log.warn("Partial status: the last scan didn't complete.")
+        
     min_ctime = None
     for fname, desc in config.STATUS_FILES_DESC.items():
         log.warn(desc)
@@ -70,7 +94,7 @@ def do_show(repo):
         
         with open(fpath) as fname_f:
             if fname is config.GOOD_FILES:
-                log.info("{} entries".format(len(fname_f.readlines())))
+                log.info("{} entries".format(count_entries(fpath)))
             else:
                 has = False
                 for line in fname_f.readlines():
@@ -82,36 +106,167 @@ def do_show(repo):
     
     if min_ctime is not None:
         log.warn("  Status file created on: {}".format(time.ctime(min_ctime)))
-    log.info("Database file created on: {}".format(time.ctime(os.path.getctime(repo.db_file))))
+    db_file = storage.open_database(repo).path
+    log.info("Database file created on: {}".format(time.ctime(os.path.getctime(db_file))))
     
-def status(repo, fs_dir, do_checksum):
+def status(repo, fs_dir, do_checksum, jobs=1, rehash=False, do_fingerprint=False, do_quick=False, database=None):
     log.info("Getting status of {} ({}) against repository '{}'.".format(repo.copyname, fs_dir, repo.name))
-             
-    compare_and_save_fs_db(repo, fs_dir, do_checksum)
+    started = time.time_ns()
 
-def is_missing_in_fs(fs_fullpath, db_fullpath):
-    # files are first
+    try: os.mkdir(repo.tmp_dir)
+    except FileExistsError: pass # ignore
+
+    if database is None:
+        database = storage.open_database(repo)
+    
+    # only the changed directories are scanned if the copy is watched,
+    # the position is taken before the copy is read (see watch.py)
+    position = watch.log_position(repo)
+    dirty = watch.dirty_set(repo, database, do_checksum, do_fingerprint) if position else None
+    # or the ones whose mtime changed, if asked to
+    if dirty is None and do_quick:
+        dirty = dirstate.quick_dirty(repo, fs_dir, database, do_checksum, do_fingerprint)
+
+    if dirty is None:
+        summaries = database.dir_summaries()
+        dir_mtimes = dirstate.snapshot(fs_dir, summaries)
+    
+    with hashcache.HashCache(repo.HASH_CACHE, rehash) as cache:
+        results = compare_and_save_fs_db(repo, fs_dir, do_checksum, jobs, cache,
+                                         do_fingerprint, dirty, database)
+
+        if results:
+            save_meta(repo, started, database, results, do_checksum, do_fingerprint, dirty is None)
+        
+        if results and dirty is None:
+            watch.save_baseline(repo, position, database, results.changed_dirs, do_checksum, do_fingerprint)
+            dirstate.save(repo, dir_mtimes, summaries, results.changed_dirs, do_checksum, do_fingerprint)
+            
+            if do_checksum:
+                cache.compact()
+
+# How the status files were computed (STATUS_META_FILENAME), for
+# `update` to use them instead of scanning the copy again:
+#   {"started": <time.time_ns() at the beginning of the scan>,
+#    "database": [st_mtime_ns, st_size] of the database,
+#    "checksum": bool, "fingerprint": bool, "complete": bool (not --quick/watched),
+#    "good": GOOD_FILES_MODE}
+
+def save_meta(repo, started, database, results, do_checksum, do_fingerprint, complete):
+    meta = {"started": started, "database": watch.database_stat(database),
+            "checksum": bool(do_checksum), "fingerprint": bool(do_fingerprint),
+            "complete": complete, "good": results.good_mode, "previous": results.nb_previous}
+
+    tmp_meta_file = "{}.tmp".format(repo.STATUS_META)
+    with open(tmp_meta_file, "w") as meta_f:
+        json.dump(meta, meta_f)
+    os.replace(tmp_meta_file, repo.STATUS_META)
+
+def load_meta(repo):
+    try:
+        with open(repo.STATUS_META) as meta_f:
+            return json.load(meta_f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def read_status_file(repo, fname):
+    # entries of a status file, in their order
+    with open(repo.get_status_fname(fname)) as status_f:
+        for line in status_f:
+            relpath, _, info_txt = line.rstrip("\n").partition(" -> ")
+            yield relpath, common.parse_info(info_txt)
+
+def reachable_copies(repo):
+    # returns {st_dev: [(copy repository, directory)]}, and the names of
+    # the copies not reachable
+    devices = OrderedDict()
+    unreachable = []
+    
+    for copyname, dirname in sorted(repo.get_copies().items()):
+        try:
+            with os.scandir(dirname) as dir_it:
+                if next(dir_it, None) is None:
+                    # don't report all the files missing
+                    raise FileNotFoundError("empty directory, disk not mounted?")
+            st_dev = os.stat(dirname).st_dev
+        except OSError as e:
+            log.warn("Copy '{}' ({}) not reachable: {}".format(copyname, dirname, e))
+            unreachable.append(copyname)
+            continue
+        
+        copy_repo = common.Repository(repo.name)
+        copy_repo.set_copyname(copyname)
+        devices.setdefault(st_dev, []).append((copy_repo, dirname))
+
+    return devices, unreachable
+
+def status_all_copies(repo, do_checksum, jobs=1, rehash=False, do_fingerprint=False, do_quick=False, force=False):
+    # one worker per device, the copies of a device are scanned one after
+    # the other (concurrent scans of a disk only make it seek), against
+    # the same database, parsed once.
+    devices, unreachable = reachable_copies(repo)
+    if not devices:
+        log.critical("No copy of repository '{}' reachable.".format(repo.name))
+        return
+    
+    database = storage.LoadedDatabase(storage.open_database(repo))
+
+    def scan_device(copies):
+        for copy_repo, dirname in copies:
+            if has_status(copy_repo) and not force:
+                log.info("Status of {} already computed (run with --force to rescan).".format(copy_repo.copyname))
+                continue
+            
+            do_clean(copy_repo)
+            status(copy_repo, dirname, do_checksum, jobs, rehash, do_fingerprint, do_quick, database)
 
-    db_dir, _, db_name = db_fullpath.rpartition("/")
-    fs_dir, _, fs_name = fs_fullpath.rpartition("/")
+    # the progress lines of the workers would overwrite each other
+    progress.enabled = len(devices) == 1
     
-    missing_in_fs = (
-        # not in the same directory ?
-        db_dir < fs_dir if fs_dir != db_dir 
-        else db_name < fs_name)
+    with ThreadPoolExecutor(len(devices)) as executor:
+        for scan in [executor.submit(scan_device, copies) for copies in devices.values()]:
+            scan.result()
+
+    log.warn("Status of the copies of repository '{}':".format(repo.name))
+    for copies in devices.values():
+        for copy_repo, dirname in copies:
+            counts = status_counts(copy_repo)
+            if counts is None:
+                log.warn("{:12s} no status".format(copy_repo.copyname))
+                continue
+            
+            behind = ["{} {}".format(counts[fname], config.STATUS_FILES_DESC[fname].lower())
+                      for fname in config.STATUS_FILES_DESC
+                      if fname != config.GOOD_FILES and counts[fname]]
+            if behind:
+                log.warn("{:12s} behind: {}".format(copy_repo.copyname, ", ".join(behind)))
+            else:
+                log.info("{:12s} up to date ({} files)".format(copy_repo.copyname, counts[config.GOOD_FILES]))
+            
+    for copyname in unreachable:
+        log.warn("{:12s} not reachable".format(copyname))
+
+def status_counts(repo):
+    # number of entries of each status file, None if there is no status
+    if not has_status(repo):
+        return None
+
+    return {fname: count_entries(repo.get_status_fname(fname)) for fname in config.STATUS_FILES}
+
+def is_missing_in_fs(fs_relpath, db_relpath):
+    # files are first
+    missing_in_fs = common.path_key(db_relpath) < common.path_key(fs_relpath)
 
     return (FileState.MISSING_IN_FS if missing_in_fs
             else FileState.MISSING_ON_DB)
     
 
-def compare_entries(fs_dir, fs_entry, db_entry, do_checksum):    
+def compare_entries(fs_dir, fs_entry, db_entry, do_checksum, cache=None):    
     fs_fullpath, fs_relpath, fs_info = fs_entry
     db_relpath, db_info = db_entry
 
-    db_fullpath = "{}/{}".format(fs_dir, db_relpath)
-    
-    if fs_fullpath != db_fullpath:
-        state = is_missing_in_fs(fs_fullpath, db_fullpath)
+    if fs_relpath != db_relpath:
+        state = is_missing_in_fs(fs_relpath, db_relpath)
         
         if state is FileState.MISSING_IN_FS:
             log.warn("{} # missing in fs".format(db_relpath, fs_relpath))
@@ -120,14 +275,29 @@ def compare_entries(fs_dir, fs_entry, db_entry, do_checksum):
 
         return state, None
 
+    # checksum with the algorithm of db_info, if not the one of the repository
+    previous_md5sum = fs_info.pop("previous_md5sum", None)
     errors = {}
     
     for key, fs_val in fs_info.items():
         if key == "md5sum" and not do_checksum:
             # ignore checksum
             continue
-        
+
+        if key == "fingerprint" and key not in db_info:
+            # entry recorded without fingerprint: only the size is compared
+            # (see compare_fs_db), `update --fingerprint` records it
+            continue
+            
         db_val = db_info[key]
+
+        if key == "md5sum" and common.digest_algorithm(db_val) != common.digest_algorithm(fs_val):
+            # entry hashed with a previous algorithm of the repository,
+            # hashed by the workers along with the other (see common.browse_filesystem)
+            fs_val = previous_md5sum
+            if fs_val is None: # partial scan
+                fs_val = common.get_file_info(fs_fullpath, True, cache,
+                                              algorithm=common.digest_algorithm(db_val))["md5sum"]
         
         if db_val == fs_val:
             # value is correct
@@ -149,12 +319,20 @@ class FileState(Enum):
      MISSING_IN_FS,
      MOVED) = range(5)
     
-def progress_on_fs_and_db(repo, fs_dir, do_checksum):
-    total_len = common.db_length(repo.db_file)
-
-    count = 0
-    db = common.browse_db(repo.db_file)
-    fs = common.browse_filesystem(fs_dir, do_checksum)
+def progress_on_fs_and_db(database, fs_dir, do_checksum, jobs=1, cache=None, do_fingerprint=False, dirty=None):
+    # only the checksums depend on the size of the files
+    prog = progress.Progress(len(database), database.total_size(), by_bytes=do_checksum)
+    
+    db = profiling.timed_iter("db read", database.browse())
+    # time spent waiting for the filesystem entries (walk, stat, hash ...)
+    if dirty is None:
+        # the walk reads the database too, on its own, for the entries of a previous algorithm
+        fs = common.browse_filesystem(fs_dir, do_checksum, jobs, cache, database.algorithm, do_fingerprint,
+                                      database.browse() if do_checksum else None)
+    else:
+        fs = watch.browse_partial(fs_dir, database, dirty, do_checksum, jobs, cache,
+                                  database.algorithm, do_fingerprint)
+    fs = profiling.timed_iter("scan", fs)
     state = FileState.OK
 
     while True:
@@ -177,12 +355,26 @@ def progress_on_fs_and_db(repo, fs_dir, do_checksum):
         if fs_entry is None:
             # new directory
             continue 
+
+        while isinstance(fs_entry, watch.Unchanged):
+            # fast-forward across a directory not scanned: its entries are good
+            if db_entry is not False and common.path_key(db_entry[0]) < fs_entry.key:
+                log.warn("{} # missing in fs".format(db_entry[0]))
+                prog.update(nbytes=int(db_entry[1]["size"]))
+                yield FileState.MISSING_IN_FS, None, db_entry, fs_entry
+            elif db_entry is not False and fs_entry.contains(db_entry[0]):
+                relpath, info = db_entry
+                prog.update(nbytes=int(info["size"]))
+                yield FileState.OK, None, db_entry, (os.path.join(fs_dir, relpath), relpath, info)
+            else:
+                fs_entry = next(fs)
+                continue
+            db_entry = next(db)
             
         if fs_entry is False and db_entry is False:
-            common.progress(total_len, total_len)
-            print("")
+            prog.close()
             
-            raise StopIteration()
+            return
         
         if fs_entry is False: # no more fs entries
             state = FileState.MISSING_IN_FS # so file cannot be on fs
@@ -192,22 +384,135 @@ def progress_on_fs_and_db(repo, fs_dir, do_checksum):
             
         else:
             # returns None if could compare,
-            #      or db_fullpath > fs_fullpath
-            state, diff = compare_entries(fs_dir, fs_entry, db_entry, do_checksum)
+            #      or db_relpath > fs_relpath
+            state, diff = compare_entries(fs_dir, fs_entry, db_entry, do_checksum, cache)
 
-        common.progress(count, total_len)
-        count += 1
+        if state is FileState.MISSING_IN_FS:
+            prog.update(nbytes=int(db_entry[1]["size"]))
+        else:
+            prog.update(nbytes=int(fs_entry[2]["size"]))
         
         yield state, diff, db_entry, fs_entry
 
-def compare_fs_db(repo, fs_dir, do_checksum, updating=False):
-    progress = progress_on_fs_and_db(repo, fs_dir, do_checksum)
+class StatusLists():
+    # results of the comparison, all in memory (for `update`)
+    def __init__(self):
+        self.lists = OrderedDict((fname, []) for fname in (config.GOOD_FILES, config.NEW_FILES,
+                                                           config.MISSING_FILES, config.DIFFERENT_FILES,
+                                                           config.MOVED_FILES))
+        self.changed_dirs = set() # directories with files not good
+        self.nb_previous = 0 # good files hashed with a previous algorithm in the database
+
+    @property
+    def new(self):
+        return self.lists[config.NEW_FILES]
+
+    @property
+    def missing(self):
+        return self.lists[config.MISSING_FILES]
+    
+    def add(self, fname, relpath, info):
+        if fname != config.GOOD_FILES:
+            self.changed_dirs.add(storage.parent_dir(relpath))
+            
+        self.lists[fname].append((relpath, info))
+
+    def add_rehashed(self, relpath, info):
+        # good file, with the checksum of the algorithm of the repository
+        self.add(config.GOOD_FILES, relpath, info)
+
+    def add_moved(self, moved):
+        # already removed from new and missing
+        self.lists[config.MOVED_FILES] = moved
+
+    def count(self, fname):
+        return len(self.lists[fname])
+
+class StatusFiles(StatusLists):
+    # results of the comparison written in the status files as they come,
+    # only the new and missing files are kept, for the moved detection.
+    # STATUS_PARTIAL exists until all the files are written: an
+    # interrupted scan leaves the status of the files compared so far.
+    def __init__(self, repo, good_mode=None):
+        super().__init__()
+        self.repo = repo
+        self.good_mode = good_mode or config.GOOD_FILES_MODE
+        self.counts = dict.fromkeys(self.lists, 0)
+
+        open(repo.STATUS_PARTIAL, "w").close()
+        self.status_files = {fname: open(repo.get_status_fname(fname), "w")
+                             for fname in config.STATUS_FILES_DESC}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close(complete=exc_type is None)
+    
+    def add(self, fname, relpath, info):
+        if fname in (config.NEW_FILES, config.MISSING_FILES):
+            super().add(fname, relpath, info)
+        elif fname != config.GOOD_FILES:
+            self.changed_dirs.add(storage.parent_dir(relpath))
 
-    good, missing, new, different, moved = [], [], [], [], []
+        self.counts[fname] += 1
+        self.write(fname, relpath, info)
+
+    def write(self, fname, relpath, info):
+        status_f = self.status_files[fname]
+        
+        if fname != config.GOOD_FILES or self.good_mode == "full":
+            common.print_a_file(relpath, info, status_f)
+        elif self.good_mode == "compact":
+            print(relpath, file=status_f)
     
+    def add_moved(self, moved):
+        if moved:
+            # new and missing files written again, without the moved ones
+            for fname in (config.NEW_FILES, config.MISSING_FILES):
+                status_f = self.status_files[fname]
+                status_f.seek(0)
+                status_f.truncate()
+                
+                for relpath, info in self.lists[fname]:
+                    common.print_a_file(relpath, info, status_f)
+                self.counts[fname] = len(self.lists[fname])
+
+        for relpath, info in moved:
+            self.counts[config.MOVED_FILES] += 1
+            self.write(config.MOVED_FILES, relpath, info)
+
+    def count(self, fname):
+        return self.counts[fname]
+
+    def close(self, complete=True):
+        if complete and self.good_mode == "count":
+            print(common.format_db_header(OrderedDict((
+                            ("good", "{:012d}".format(self.counts[config.GOOD_FILES])),))),
+                  file=self.status_files[config.GOOD_FILES])
+            
+        for status_f in self.status_files.values():
+            status_f.close()
+
+        if complete:
+            os.remove(self.repo.STATUS_PARTIAL)
+
+def compare_fs_db(repo, fs_dir, do_checksum, updating=False, jobs=1, cache=None, do_fingerprint=False, dirty=None,
+                  database=None, results=None):
+    # results: StatusLists by default, returned
+    if database is None:
+        database = storage.open_database(repo)
+    if results is None:
+        results = StatusLists()
+        
+    progress = progress_on_fs_and_db(database, fs_dir, do_checksum, jobs, cache, do_fingerprint, dirty)
+    nb_size_only = 0 # good files without fingerprint in the database
+
+    # self time of "compare": the merge-join itself
     try:
         while True:
-            state, diff, db_entry, fs_entry = next(progress)
+            with profiling.phase("compare"):
+                state, diff, db_entry, fs_entry = next(progress)
 
             try:
                 fs_fullpath, fs_relpath, fs_info = fs_entry
@@ -217,92 +522,189 @@ def compare_fs_db(repo, fs_dir, do_checksum, updating=False):
                 db_relpath, db_info = db_entry
             except Exception: pass
             
+            add = results.add
             if state is FileState.OK:
-                good.append((db_relpath, db_info))
+                if "fingerprint" in fs_info and "fingerprint" not in db_info:
+                    db_info = db_info.copy()
+                    db_info["fingerprint"] = fs_info["fingerprint"]
+                    nb_size_only += 1
+
+                if do_checksum and common.digest_algorithm(db_info["md5sum"]) != common.digest_algorithm(fs_info["md5sum"]):
+                    results.nb_previous += 1
+                    if updating:
+                        # the checksum of the algorithm of the repository replaces it
+                        db_info = db_info.copy()
+                        db_info["md5sum"] = fs_info["md5sum"]
+                        add = lambda fname, relpath, info: results.add_rehashed(relpath, info)
+
+                fname, relpath, info = config.GOOD_FILES, db_relpath, db_info
                 
             elif state is FileState.DIFFERENT:
                 assert diff
 
-                different.append((db_relpath, diff))
+                fname, relpath, info = config.DIFFERENT_FILES, db_relpath, diff
                 
             elif state is FileState.MISSING_IN_FS:
                 if not updating:
                     assert not os.path.exists("{}/{}".format(fs_dir, db_relpath))
                 
-                missing.append((db_relpath, db_info))
+                fname, relpath, info = config.MISSING_FILES, db_relpath, db_info
                 
             elif state is FileState.MISSING_ON_DB:
-                if not updating:
-                    command = '/usr/bin/grep "{}" "{}" --quiet'.format(fs_relpath, repo.db_file)
+                if not updating and config.DEBUG_SLOW_CHECKS and database.name == "text":
+                    command = '/usr/bin/grep "{}" "{}" --quiet'.format(fs_relpath, database.path)
                     assert os.system(command) # assert !0 (text not found)
+                elif not updating:
+                    # relpaths index built once, on the first new file
+                    assert fs_relpath not in database
                 
-                new.append((fs_relpath, fs_info))
+                fname, relpath, info = config.NEW_FILES, fs_relpath, fs_info
                 
             else: # MOVED should not happend here
                 log.critical("Incorrect state: {}".format(state))
                 assert False # should not come here
+
+            with profiling.phase("status files", files=1):
+                add(fname, relpath, info)
                 
     except StopIteration:
         pass
 
-    # compute moved files
-    for new_file_info in list(new):
-        new_file, new_info = new_file_info
-        
-        if not do_checksum: # if checksum not computed before
-            fs_fullpath = os.path.join(fs_dir, new_file)
-            new_info = common.get_file_info(fs_fullpath, do_checksum=True)
+    if nb_size_only and not do_checksum and not updating:
+        log.warn("{} files without fingerprint in the database, only compared by size: "
+                 "run `update --fingerprint` to record them.".format(nb_size_only))
+    if results.nb_previous and not updating:
+        log.warn("{} files hashed with a previous algorithm in the database: "
+                 "run `update --checksum` to replace them.".format(results.nb_previous))
 
-        missing_file_info = [(i, missing_file_info[0]) for i, missing_file_info in enumerate(missing)
-                      if missing_file_info[1]["md5sum"] == new_info["md5sum"]]
+    with profiling.phase("moved", files=len(results.new)):
+        moved = find_moved(fs_dir, results.new, results.missing, do_checksum, jobs, cache, database.algorithm)
 
-        if not missing_file_info:
-            continue
+    with profiling.phase("status files", files=len(moved)):
+        results.add_moved(moved)
+        
+    return results
+    
+def path_distance(relpath, other_relpath):
+    # number of directories to go up and down from one file to the other,
+    # then same name first, then alphabetical for determinism
+    dirs, _, name = relpath.rpartition("/")
+    other_dirs, _, other_name = other_relpath.rpartition("/")
+
+    dirs = dirs.split("/") if dirs else []
+    other_dirs = other_dirs.split("/") if other_dirs else []
+
+    common_len = 0
+    for a_dir, other_dir in zip(dirs, other_dirs):
+        if a_dir != other_dir:
+            break
+        common_len += 1
+
+    return (len(dirs) + len(other_dirs) - 2*common_len,
+            name != other_name,
+            other_relpath)
+
+def find_moved(fs_dir, new, missing, do_checksum, jobs=1, cache=None, algorithm="md5"):
+    # new and missing are updated in place, moved entries are returned.
+    
+    missing_by_md5 = {}
+    algorithms_by_size = {}
+    fingerprints_by_size = {}
+    for missing_file, missing_info in missing:
+        key = missing_info["size"], missing_info["md5sum"]
+        missing_by_md5.setdefault(key, []).append(missing_file)
+
+        # the missing files may have been hashed with an older algorithm
+        algorithms_by_size.setdefault(missing_info["size"], set()).add(
+            common.digest_algorithm(missing_info["md5sum"]))
+        
+        fingerprints_by_size.setdefault(missing_info["size"], set()).add(
+            missing_info.get("fingerprint"))
+
+    def may_be_moved(new_info):
+        # a new file of a size matching no missing file cannot have been moved,
+        # so it doesn't have to be hashed. Same with the fingerprints, if known.
+        fingerprints = fingerprints_by_size.get(new_info["size"])
+        if not fingerprints:
+            return False
+        
+        return (None in fingerprints or "fingerprint" not in new_info
+                or new_info["fingerprint"] in fingerprints)
+    
+    candidates = [(new_file, new_info) for new_file, new_info in new
+                  if may_be_moved(new_info)]
 
-        assert len(missing_file_info) == 1
-        idx, missing_file = missing_file_info[0]
+    if not candidates:
+        return []
+    
+    def with_checksum(new_file_info):
+        new_file, new_info = new_file_info
+        
+        fs_fullpath = os.path.join(fs_dir, new_file)
+        
+        if not new_info["md5sum"]: # if checksum not computed before
+            fs_info = common.get_file_info(fs_fullpath, do_checksum=True, cache=cache,
+                                           algorithm=algorithm)
+            if "fingerprint" in new_info:
+                fs_info["fingerprint"] = new_info["fingerprint"] # recorded with the move
+            new_info = fs_info
+
+        digests = {common.digest_algorithm(new_info["md5sum"]): new_info["md5sum"]}
+        for other_algorithm in algorithms_by_size[new_info["size"]] - digests.keys():
+            digests[other_algorithm] = common.get_file_info(fs_fullpath, True, cache,
+                                                            algorithm=other_algorithm)["md5sum"]
+            
+        return new_file, new_info, digests.values()
+
+    moved = []
+    moved_from = set()
+    for new_file, new_info, digests in common.ordered_map(with_checksum, candidates, jobs):
+        for digest in digests:
+            same_files = missing_by_md5.get((new_info["size"], digest))
+            if same_files: break
+        
+        if not same_files:
+            continue
 
+        # duplicated content: pair with the closest missing file
+        missing_file = min(same_files, key=lambda missing_file: path_distance(new_file, missing_file))
+        same_files.remove(missing_file)
+        
         info = new_info.copy()
         info["moved_from"] = missing_file
         moved.append((new_file, info))
+        moved_from.add(missing_file)
+        
         log.warning("{} # actually moved from {}".format(new_file, missing_file))
 
-        missing.pop(idx)
-        new.remove(new_file_info)
-        
-    return OrderedDict((
-            (config.GOOD_FILES, good),
-            (config.NEW_FILES, new),
-            (config.MISSING_FILES, missing),
-            (config.DIFFERENT_FILES, different),
-            (config.MOVED_FILES, moved),
-            ))
+    moved_to = {new_file for new_file, info in moved}
     
-def compare_and_save_fs_db(repo, fs_dir, do_checksum):
+    new[:] = [entry for entry in new if entry[0] not in moved_to]
+    missing[:] = [entry for entry in missing if entry[0] not in moved_from]
+
+    return moved
+
+def compare_and_save_fs_db(repo, fs_dir, do_checksum, jobs=1, cache=None, do_fingerprint=False, dirty=None,
+                           database=None):
+    # returns the StatusFiles, or None if the comparison could not be done
     if not os.path.exists(fs_dir):
         log.critical("Path '{}' does not exist.".format(fs_dir))
-        return
+        return None
 
-    if not common.db_length(repo.db_file):
+    if database is None:
+        database = storage.open_database(repo)
+
+    if not len(database):
         log.critical("Database is empty.")
-        return
+        return None
     
-    status_files = {fname: open(repo.get_status_fname(fname), "w+")
-                    for fname, descr in config.STATUS_FILES_DESC.items()}
-
-    lists_of_files = compare_fs_db(repo, fs_dir, do_checksum)
+    with StatusFiles(repo) as results:
+        compare_fs_db(repo, fs_dir, do_checksum, jobs=jobs, cache=cache,
+                      do_fingerprint=do_fingerprint, dirty=dirty, database=database, results=results)
         
-    log.warn("Done, {} files compared.".format(sum(map(len, lists_of_files.values()))))
+    log.warn("Done, {} files compared.".format(sum(map(results.count, results.lists))))
 
-    for fname, flist in lists_of_files.items():
-        log.info("{}: {}".format(config.STATUS_FILES_DESC[fname], len(flist)))
-        status_f = status_files[fname]
+    for fname in results.lists:
+        log.info("{}: {}".format(config.STATUS_FILES_DESC[fname], results.count(fname)))
 
-        for entry in flist:
-            relpath, info = entry
-                
-            
-            common.print_a_file(relpath, info, status_f)
-        
-    for status_file in status_files.values():
-        status_file.close()
+    return results
@@ -0,0 +1,634 @@
+import os
+import sqlite3
+import hashlib
+import heapq
+import tempfile
+from collections import OrderedDict
+
+import common, config, profiling
+
+import logging; log = logging.getLogger('backup.storage')
+
+# Database backends share the same interface:
+#   len(db), db.total_size(), relpath in db, db.get(relpath), db.find_md5sum(md5sum),
+#   db.browse() -- entries in walk order, then False (like browse_filesystem),
+#   db.write(entries) -- replaces the whole content,
+#   db.updater() -- context manager to keep/put/delete entries in place,
+#   db.algorithm, db.set_algorithm(name) -- checksum algorithm of the new entries,
+#   db.dir_summaries() -- {dirpath: summary} of all the directories (see DirSummaries).
+# With the updater, every entry of the database must be passed to
+# keep(), put() or delete(), in any order. If updater.streaming, they
+# can be passed while the database is browsed.
+
+def open_database(repo):
+    if os.path.exists(repo.sqlite_db_file):
+        return SQLiteDatabase(repo.sqlite_db_file)
+
+    return TextDatabase(repo.db_file)
+
+def new_database(repo, backend, algorithm="md5"):
+    # nothing is written before db.write()
+    if backend == "sqlite":
+        return SQLiteDatabase(repo.sqlite_db_file, algorithm)
+    elif backend == "text":
+        return TextDatabase(repo.db_file, algorithm)
+
+    raise ValueError("Unknown database backend '{}'.".format(backend))
+
+# Per-directory aggregates of the entries, kept up to date with them:
+#   files, size -- number and total size of the files of the subtree,
+#   own -- md5 of the name, size and checksum of the files of the directory.
+# The root directory is "".
+
+def parent_dir(dirpath):
+    return dirpath.rpartition("/")[0]
+
+def own_summary(files):
+    # files: [(name, info)] sorted by name
+    own = hashlib.md5()
+    size = 0
+    for name, info in files:
+        own.update("{}\0{}\0{}\n".format(name, info["size"], info.get("md5sum", "")).encode())
+        size += int(info["size"])
+    return len(files), size, own.hexdigest()
+
+def combine_summaries(own_summaries, get_children=None, dirpaths=None):
+    # own_summaries: {dirpath: own_summary()} of the directories with files.
+    # dirpaths: directories to compute (default: the ones with files).
+    # get_children(dirpath): summaries of its subdirectories not computed
+    # here, {name: summary}. Returns {dirpath: summary}, parents included,
+    # without the directories left empty (but the root).
+    dirpaths = set(own_summaries if dirpaths is None else dirpaths)
+    for dirpath in list(dirpaths):
+        while dirpath:
+            dirpath = parent_dir(dirpath)
+            if dirpath in dirpaths: break
+            dirpaths.add(dirpath)
+
+    children = {}
+    for dirpath in dirpaths:
+        if dirpath:
+            children.setdefault(parent_dir(dirpath), []).append(dirpath)
+
+    summaries = {}
+    # deepest first, so that the subdirectories are done before their parent
+    for dirpath in sorted(dirpaths, key=lambda dirpath: -dirpath.count("/") - bool(dirpath)):
+        nb_files, size, own = own_summaries.get(dirpath, (0, 0, hashlib.md5().hexdigest()))
+
+        subdirs = get_children(dirpath) if get_children else {}
+        for child in children.get(dirpath, []):
+            if summaries[child]["files"]:
+                subdirs[child.rpartition("/")[2]] = summaries[child]
+            else:
+                subdirs.pop(child.rpartition("/")[2], None) # now empty
+
+        for name in subdirs:
+            nb_files += int(subdirs[name]["files"])
+            size += int(subdirs[name]["size"])
+
+        summaries[dirpath] = OrderedDict((("files", nb_files), ("size", size), ("own", own)))
+
+    return {dirpath: summary for dirpath, summary in summaries.items()
+            if summary["files"] or not dirpath}
+
+class DirSummaries():
+    # computes the summaries of entries passed in walk order (the files
+    # of a directory are contiguous)
+    def __init__(self):
+        self.own_summaries = {}
+        self.dirpath = None
+        self.files = []
+
+    def add(self, relpath, info):
+        dirpath, _, name = relpath.rpartition("/")
+        if dirpath != self.dirpath:
+            self.flush()
+            self.dirpath = dirpath
+        self.files.append((name, info))
+
+    def flush(self):
+        if self.files:
+            self.own_summaries[self.dirpath] = own_summary(self.files)
+            self.files = []
+
+    def summaries(self):
+        self.flush()
+        return combine_summaries(self.own_summaries)
+
+def summarize(entries):
+    dir_summaries = DirSummaries()
+    for entry in entries:
+        if entry:
+            dir_summaries.add(*entry)
+    return dir_summaries.summaries()
+
+class LoadedDatabase():
+    # read-only copy in memory of a database, parsed once and browsed by
+    # several threads (`status --all-copies`)
+    def __init__(self, database):
+        self.name = database.name
+        self.path = database.path
+        self.algorithm = database.algorithm
+
+        with profiling.phase("db read"):
+            self.entries = [entry for entry in database.browse() if entry]
+        self.size = sum(int(info["size"]) for relpath, info in self.entries)
+        self.summaries = database.dir_summaries()
+        self._relpaths = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def total_size(self):
+        return self.size
+
+    def browse(self):
+        yield from self.entries
+        yield False
+
+    def relpaths(self):
+        if self._relpaths is None:
+            self._relpaths = {relpath for relpath, info in self.entries}
+        return self._relpaths
+
+    def __contains__(self, relpath):
+        return relpath in self.relpaths()
+
+    def dir_summaries(self):
+        return self.summaries
+
+class TextDatabase():
+    name = "text"
+
+    def __init__(self, path, algorithm=None):
+        self.path = path
+        # the directory summaries are in <db>.dirs.txt
+        self.dirs_path = "{}.dirs{}".format(*os.path.splitext(path))
+        self._index = None
+        self._md5_index = None
+        self._relpaths = None
+        self._algorithm = algorithm
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def remove(self):
+        os.remove(self.path)
+        
+        try: os.remove(self.dirs_path)
+        except FileNotFoundError: pass
+
+    def __len__(self):
+        return common.db_length(self.path)
+
+    def total_size(self):
+        # None if the database was written before the header had it
+        size = self.read_header().get("bytes")
+        return int(size) if size is not None else None
+
+    def read_header(self):
+        try:
+            with open(self.path) as db_f:
+                return common.parse_db_header(db_f.readline()) or {}
+        except FileNotFoundError:
+            return {}
+
+    @property
+    def algorithm(self):
+        if self._algorithm is None:
+            self._algorithm = self.read_header().get("algorithm", "md5")
+        return self._algorithm
+
+    def set_algorithm(self, algorithm):
+        self._algorithm = algorithm
+
+        if self.exists() and self.read_header().get("algorithm", "md5") != algorithm:
+            self.write(entry for entry in self.browse() if entry)
+
+    def browse(self):
+        return common.browse_db(self.path)
+
+    def relpaths(self):
+        # cheaper than index(), only the path of the entries is kept
+        if self._relpaths is None:
+            if self._index is not None:
+                self._relpaths = self._index.keys()
+            else:
+                with open(self.path) as db_f:
+                    self._relpaths = {line.partition(" -> ")[0]
+                                      for line in common.db_lines(db_f)}
+        return self._relpaths
+
+    def index(self):
+        if self._index is None:
+            self._index = dict(entry for entry in self.browse() if entry)
+        return self._index
+
+    def __contains__(self, relpath):
+        return relpath in self.relpaths()
+
+    def get(self, relpath):
+        return self.index().get(relpath)
+
+    def find_md5sum(self, md5sum):
+        if self._md5_index is None:
+            self._md5_index = {}
+            for relpath, info in self.index().items():
+                self._md5_index.setdefault(info["md5sum"], []).append(relpath)
+
+        return self._md5_index.get(md5sum, [])
+
+    def write(self, entries):
+        tmp_db_file = "{}.tmp".format(self.path)
+        try:
+            with profiling.phase("db write"), open(tmp_db_file, "w+") as tmp_db_f:
+                # placeholder, rewritten when the number of entries is known
+                print(self.header(0), file=tmp_db_f)
+
+                dir_summaries = DirSummaries()
+                count = size = 0
+                for relpath, info in entries:
+                    common.print_a_file(relpath, info, tmp_db_f)
+                    dir_summaries.add(relpath, info)
+                    count += 1
+                    size += int(info["size"])
+
+                tmp_db_f.seek(0)
+                print(self.header(count, size), file=tmp_db_f)
+        except:
+            os.remove(tmp_db_file)
+            raise
+
+        os.replace(tmp_db_file, self.path)
+        self._index = self._md5_index = self._relpaths = None
+
+        # after the database: if interrupted, the sidecar is older (see dir_summaries)
+        self.write_dir_summaries(dir_summaries.summaries())
+
+    def write_dir_summaries(self, summaries):
+        tmp_dirs_file = "{}.tmp".format(self.dirs_path)
+        with open(tmp_dirs_file, "w") as tmp_dirs_f:
+            for dirpath in sorted(summaries, key=lambda dirpath: dirpath.split("/")):
+                common.print_a_file(dirpath, summaries[dirpath], tmp_dirs_f)
+        os.replace(tmp_dirs_file, self.dirs_path)
+
+    def dir_summaries(self):
+        # computed from the entries if the sidecar file is missing or
+        # older than the database (written by a previous version)
+        try:
+            if os.stat(self.dirs_path).st_mtime_ns >= os.stat(self.path).st_mtime_ns:
+                summaries = {}
+                with open(self.dirs_path) as dirs_f:
+                    for line in dirs_f:
+                        dirpath, _, info_str = line[:-1].partition(" -> ")
+                        summaries[dirpath] = common.parse_info(info_str)
+                return summaries
+        except FileNotFoundError:
+            pass
+
+        log.info("Computing the directory summaries of {} ...".format(self.path))
+        return summarize(self.browse())
+
+    def header(self, count, size=0):
+        return common.format_db_header(OrderedDict((
+                    ("entries", "{:012d}".format(count)),
+                    ("bytes", "{:016d}".format(size)),
+                    ("algorithm", self.algorithm),
+                    )))
+
+    def updater(self):
+        return TextUpdater(self)
+
+class TextUpdater():
+    # The entries passed in the database order are written to a temporary
+    # file as they come. The others (new, moved files...) are sorted by
+    # runs of UPDATE_SORT_ENTRIES, spilled to temporary files. All are
+    # merged into the new database on exit: the memory used doesn't
+    # depend on the size of the database.
+    streaming = True
+    
+    def __init__(self, db):
+        self.db = db
+        self.tmp_dir = os.path.dirname(os.path.abspath(db.path))
+        
+        self.ordered_f = None
+        self.last_key = None
+        self.unordered = [] # (path_key, relpath, info)
+        self.runs = []
+
+    def __enter__(self):
+        self.ordered_f = tempfile.TemporaryFile("w+", dir=self.tmp_dir)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                self.db.write(self.merge())
+        finally:
+            for run_f in [self.ordered_f] + self.runs:
+                run_f.close()
+
+    def keep(self, relpath, info):
+        self.put(relpath, info)
+
+    def put(self, relpath, info):
+        key = common.path_key(relpath)
+        if self.last_key is None or key > self.last_key:
+            self.last_key = key
+            common.print_a_file(relpath, info, self.ordered_f)
+            return
+
+        self.unordered.append((key, relpath, info))
+        if len(self.unordered) >= config.UPDATE_SORT_ENTRIES:
+            self.spill()
+
+    def delete(self, relpath):
+        pass # not written back
+
+    def spill(self):
+        run_f = tempfile.TemporaryFile("w+", dir=self.tmp_dir)
+        for key, relpath, info in sorted(self.unordered, key=lambda entry: entry[0]):
+            common.print_a_file(relpath, info, run_f)
+            
+        self.runs.append(run_f)
+        self.unordered = []
+
+    def merge(self):
+        runs = [read_run(run_f) for run_f in [self.ordered_f] + self.runs]
+        runs.append((relpath, info) for key, relpath, info
+                    in sorted(self.unordered, key=lambda entry: entry[0]))
+
+        return heapq.merge(*runs, key=lambda entry: common.path_key(entry[0]))
+
+def read_run(run_f):
+    run_f.seek(0)
+    for line in run_f:
+        relpath, _, info_txt = line.rstrip("\n").partition(" -> ")
+        yield relpath, common.parse_info(info_txt)
+
+class SQLiteDatabase():
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            relpath TEXT PRIMARY KEY,
+            dirkey  TEXT NOT NULL,
+            name    TEXT NOT NULL,
+            md5sum  TEXT,
+            size    INTEGER,
+            info    TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS files_order  ON files (dirkey, name);
+        CREATE INDEX IF NOT EXISTS files_md5sum ON files (md5sum);
+        CREATE INDEX IF NOT EXISTS files_size   ON files (size);
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS dirs (
+            dirpath TEXT PRIMARY KEY,
+            parent  TEXT,
+            files   INTEGER NOT NULL,
+            size    INTEGER NOT NULL,
+            own     TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+    """
+
+    def __init__(self, path, algorithm=None):
+        self.path = path
+        self._conn = None
+        self._algorithm = algorithm
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def remove(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        os.remove(self.path)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def total_size(self):
+        return int(self.conn.execute("SELECT TOTAL(size) FROM files").fetchone()[0])
+
+    @property
+    def algorithm(self):
+        if self._algorithm is None:
+            row = (self.conn.execute("SELECT value FROM meta WHERE key = 'algorithm'").fetchone()
+                   if self.exists() else None)
+            self._algorithm = row[0] if row else "md5"
+        return self._algorithm
+
+    def set_algorithm(self, algorithm):
+        self._algorithm = algorithm
+        
+        with self.conn:
+            self.conn.execute(self.SET_ALGORITHM, (algorithm,))
+
+    SET_ALGORITHM = "INSERT OR REPLACE INTO meta VALUES ('algorithm', ?)"
+
+    def browse(self):
+        for relpath, info_txt in self.conn.execute(
+                "SELECT relpath, info FROM files ORDER BY dirkey, name"):
+            yield relpath, common.parse_info(info_txt)
+        yield False
+
+    def relpaths(self):
+        return (relpath for relpath, in self.conn.execute("SELECT relpath FROM files"))
+
+    def __contains__(self, relpath):
+        return self.conn.execute("SELECT 1 FROM files WHERE relpath = ?",
+                                 (relpath,)).fetchone() is not None
+
+    def get(self, relpath):
+        row = self.conn.execute("SELECT info FROM files WHERE relpath = ?",
+                                (relpath,)).fetchone()
+
+        return common.parse_info(row[0]) if row else None
+
+    def find_md5sum(self, md5sum):
+        return [relpath for relpath, in self.conn.execute(
+                "SELECT relpath FROM files WHERE md5sum = ?", (md5sum,))]
+
+    def write(self, entries):
+        dir_summaries = DirSummaries()
+        def row(entry):
+            dir_summaries.add(*entry)
+            return self.row(entry)
+        
+        with profiling.phase("db write"), self.conn:
+            self.conn.execute(self.SET_ALGORITHM, (self.algorithm,))
+            self.conn.execute("DELETE FROM files")
+            self.conn.executemany(self.INSERT, map(row, entries))
+
+            self.conn.execute("DELETE FROM dirs")
+            self.write_dir_summaries(dir_summaries.summaries())
+
+    INSERT = "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)"
+
+    def write_dir_summaries(self, summaries):
+        self.conn.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)",
+                              ((dirpath, parent_dir(dirpath) if dirpath else None,
+                                summary["files"], summary["size"], summary["own"])
+                               for dirpath, summary in summaries.items()))
+
+    def dir_summaries(self):
+        summaries = {dirpath: OrderedDict((("files", nb_files), ("size", size), ("own", own)))
+                     for dirpath, nb_files, size, own in self.conn.execute(
+                             "SELECT dirpath, files, size, own FROM dirs")}
+        
+        if not summaries and len(self):
+            # database written by a previous version
+            log.info("Computing the directory summaries of {} ...".format(self.path))
+            summaries = summarize(self.browse())
+            with self.conn:
+                self.write_dir_summaries(summaries)
+            
+        return summaries
+
+    def update_dir_summaries(self, dirpaths):
+        # recomputes the directories where entries were put/deleted, and their parents
+        if not self.conn.execute("SELECT 1 FROM dirs LIMIT 1").fetchone():
+            return # not computed yet, see dir_summaries()
+        
+        todo = set()
+        for dirpath in dirpaths:
+            while dirpath not in todo:
+                todo.add(dirpath)
+                if not dirpath: break
+                dirpath = parent_dir(dirpath)
+
+        own_summaries = {}
+        for dirpath in todo:
+            files = [(name, common.parse_info(info_txt)) for name, info_txt in self.conn.execute(
+                    "SELECT name, info FROM files WHERE dirkey = ? ORDER BY name",
+                    (dirpath.replace("/", "\x01"),))]
+            if files:
+                own_summaries[dirpath] = own_summary(files)
+
+        def get_children(dirpath):
+            return {child.rpartition("/")[2]: {"files": nb_files, "size": size}
+                    for child, nb_files, size in self.conn.execute(
+                            "SELECT dirpath, files, size FROM dirs WHERE parent = ?", (dirpath,))
+                    if child not in todo}
+
+        summaries = combine_summaries(own_summaries, get_children, todo)
+
+        self.conn.executemany("DELETE FROM dirs WHERE dirpath = ?",
+                              ((dirpath,) for dirpath in todo if dirpath not in summaries))
+        self.write_dir_summaries(summaries)
+
+    @staticmethod
+    def row(entry):
+        relpath, info = entry
+        dirname, _, name = relpath.rpartition("/")
+
+        # \x01 sorts before any character of a filename,
+        # so that `ORDER BY dirkey` matches common.path_key.
+        return (relpath, dirname.replace("/", "\x01"), name,
+                info.get("md5sum"), int(info["size"]), common.format_info(info))
+
+    def updater(self):
+        return SQLiteUpdater(self)
+
+class SQLiteUpdater():
+    streaming = False # the rows browsed could change
+    
+    def __init__(self, db):
+        self.db = db
+        self.dirpaths = set() # changed directories
+
+    def __enter__(self):
+        # sqlite3 opens the transaction with the first INSERT/DELETE
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.db.update_dir_summaries(self.dirpaths)
+            self.db.conn.commit()
+        else:
+            self.db.conn.rollback()
+
+    def keep(self, relpath, info):
+        pass # already there
+
+    def put(self, relpath, info):
+        self.db.conn.execute(self.db.INSERT, self.db.row((relpath, info)))
+        self.dirpaths.add(parent_dir(relpath))
+
+    def delete(self, relpath):
+        self.db.conn.execute("DELETE FROM files WHERE relpath = ?", (relpath,))
+        self.dirpaths.add(parent_dir(relpath))
+
+def do_db(args):
+    fs_dir = os.path.abspath(".")
+
+    repo = common.get_repo(fs_dir)
+    if not repo:
+        log.critical("Could not find a repository with {} in copies...".format(fs_dir))
+        return
+
+    if args["migrate"]:
+        backend = "sqlite" if args["sqlite"] else "text"
+        migrate(repo, backend)
+
+    elif args["algorithm"]:
+        set_algorithm(repo, args["<algorithm>"])
+
+def set_algorithm(repo, algorithm):
+    if algorithm not in common.HASH_ALGORITHMS:
+        log.critical("Unknown checksum algorithm '{}', choose one of {}.".format(
+                algorithm, ", ".join(common.HASH_ALGORITHMS)))
+        return
+
+    database = open_database(repo)
+    
+    if config.NOP:
+        log.critical("NOP: set_algorithm({}, {})".format(database.path, algorithm))
+        return
+    
+    database.set_algorithm(algorithm)
+    
+    log.info("New checksums of repository '{}' will be computed with {}.".format(repo.name, algorithm))
+    log.info("Existing entries keep their checksum until they are updated.")
+
+def migrate(repo, backend):
+    src = open_database(repo)
+
+    if src.name == backend:
+        log.warn("Database of repository '{}' already uses the {} backend.".format(repo.name, backend))
+        return
+
+    if not src.exists():
+        log.critical("Database file '{}' doesn't exists.".format(src.path))
+        return
+
+    dst = new_database(repo, backend, src.algorithm)
+
+    log.info("Migrating {} into {} ...".format(src.path, dst.path))
+
+    if config.NOP:
+        log.critical("NOP: migrate({}, {})".format(src.path, dst.path))
+        return
+
+    try:
+        dst.write(entry for entry in src.browse() if entry)
+    except Exception as e:
+        log.critical("Database migration failed: {}".format(e))
+        if dst.exists():
+            dst.remove()
+        raise e
+
+    # the old database is kept aside, open_database() doesn't see it anymore
+    backup_file = "{}.bak".format(src.path)
+    os.replace(src.path, backup_file)
+
+    log.info("Database migrated ({} entries), previous one saved as {}.".format(len(dst), backup_file))
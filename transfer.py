@@ -0,0 +1,196 @@
+import os, shutil
+import errno
+import fcntl
+import hashlib
+import threading
+import time
+import concurrent.futures
+from collections import namedtuple
+
+import common, config, progress, scheduler
+
+import logging; log = logging.getLogger('backup.transfer')
+
+# Copies `src` into `dst`. If `expected` checksum is given (from the
+# status files or the database), the data is hashed while it is
+# copied, and the copy fails if it doesn't match.
+Transfer = namedtuple("Transfer", ("src", "dst", "expected"))
+
+FICLONE = 0x40049409 # linux/fs.h, _IOW(0x94, 9, int)
+
+KERNEL_COPY_FALLBACK = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                        errno.EOPNOTSUPP, errno.EBADF, errno.EPERM)
+
+class TransferError(Exception): pass
+
+def reflink(src_f, dst_f):
+    if not config.TRANSFER_REFLINK:
+        return False
+
+    try:
+        fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+        return True
+    except OSError:
+        return False # not supported by the filesystem(s)
+
+def kernel_copy(src_f, dst_f, size):
+    # returns the number of bytes copied, less than size if the source is shorter
+    src_fd, dst_fd = src_f.fileno(), dst_f.fileno()
+    chunk_size = config.TRANSFER_CHUNK_SIZE
+
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                nb_copied = os.copy_file_range(src_fd, dst_fd, min(chunk_size, size - copied))
+                if not nb_copied:
+                    break
+                copied += nb_copied
+            return copied
+        except OSError as e:
+            if copied or e.errno not in KERNEL_COPY_FALLBACK:
+                raise
+
+    try:
+        while copied < size:
+            nb_copied = os.sendfile(dst_fd, src_fd, copied, min(chunk_size, size - copied))
+            if not nb_copied:
+                break
+            copied += nb_copied
+        return copied
+    except OSError as e:
+        if copied or e.errno not in KERNEL_COPY_FALLBACK:
+            raise
+
+    return copy_and_hash(src_f, dst_f, None)[1]
+
+def copy_and_hash(src_f, dst_f, algorithm):
+    # returns (checksum of the data copied or None, number of bytes copied)
+    hashval = hashlib.new(algorithm) if algorithm else None
+
+    buf = common.get_buffer(config.HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    copied = 0
+    while True:
+        nb_read = src_f.readinto(buf)
+        if not nb_read:
+            break
+
+        if hashval is not None:
+            hashval.update(view[:nb_read])
+        dst_f.write(view[:nb_read])
+        copied += nb_read
+
+    return common.format_digest(algorithm, hashval.hexdigest()) if hashval else None, copied
+
+def copy_file(src, dst, expected=None):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+    # nothing is written at `dst` before the copy is complete and verified.
+    # With `expected`, the data is hashed as it is copied, in userspace:
+    # an in-kernel copy would have to be read again to be hashed.
+    tmp_dst = "{}{}".format(dst, config.TRANSFER_SUFFIX)
+    try:
+        with open(src, "rb", buffering=0) as src_f, open(tmp_dst, "wb", buffering=0) as dst_f:
+            size = os.fstat(src_f.fileno()).st_size
+
+            if reflink(src_f, dst_f):
+                copied = os.fstat(dst_f.fileno()).st_size
+                digest = (common.checksum(tmp_dst, common.digest_algorithm(expected))
+                          if expected else None)
+            elif expected:
+                digest, copied = copy_and_hash(src_f, dst_f, common.digest_algorithm(expected))
+            else:
+                copied = kernel_copy(src_f, dst_f, size)
+                digest = None
+
+        if copied != size:
+            raise TransferError("copied {} bytes, the source has {}".format(copied, size))
+        if expected and digest != expected:
+            raise TransferError("checksum of the copy is {}, expected {}".format(digest, expected))
+
+        shutil.copymode(src, tmp_dst)
+        os.replace(tmp_dst, dst)
+    except:
+        try: os.remove(tmp_dst)
+        except OSError: pass # ignore
+        raise
+
+    return copied
+
+def move_file(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    
+    if os.path.exists(dst):
+        raise FileExistsError(dst)
+    
+    os.rename(src, dst)
+
+    try: os.rmdir(os.path.dirname(src))
+    except OSError: pass # ignore, not empty
+    
+def run_transfers(transfers, jobs=1, journal=None):
+    # returns the transfers that failed
+    # progress is recorded in `journal` (see journal.py), if any
+
+    if not transfers:
+        return []
+
+    if config.NOP:
+        for transfer in transfers:
+            log.critical("NOP: copy_file({}, {})".format(transfer.src, transfer.dst))
+        return []
+
+    lock = threading.Lock()
+    stats = {"files": 0, "bytes": 0}
+    start = time.time()
+
+    total_size = 0
+    for transfer in transfers:
+        try: total_size += os.path.getsize(transfer.src)
+        except OSError: pass # reported when copied
+    prog = progress.Progress(len(transfers), total_size, by_bytes=True)
+
+    def do_transfer(transfer):
+        if journal is not None:
+            journal.mark(transfer, "started")
+
+        size = copy_file(*transfer)
+
+        if journal is not None:
+            journal.mark(transfer, "done")
+
+        with lock:
+            stats["files"] += 1
+            stats["bytes"] += size
+
+        return size
+
+    failed = []
+    if config.READ_ORDER:
+        transfers = scheduler.schedule(transfers, lambda transfer: scheduler.read_key(transfer.src))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor, prog:
+        futures = {executor.submit(do_transfer, transfer): transfer for transfer in transfers}
+
+        for future in concurrent.futures.as_completed(futures):
+            transfer = futures[future]
+            try:
+                prog.update(nbytes=future.result())
+            except Exception as e:
+                log.error("Copy of {} to {} failed: {}".format(transfer.src, transfer.dst, e))
+                failed.append(transfer)
+
+                if journal is not None:
+                    journal.mark(transfer, "failed", e)
+                prog.update()
+
+    elapsed = time.time() - start
+    log.info("{} files copied, {:.1f} MB in {:.1f}s ({:.1f} MB/s).".format(
+            stats["files"], stats["bytes"] / (1024*1024), elapsed,
+            stats["bytes"] / max(elapsed, 1e-6) / (1024*1024)))
+
+    if failed:
+        log.error("{} copies failed.".format(len(failed)))
+
+    return failed
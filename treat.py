@@ -1,13 +1,14 @@
 #! /usr/bin/python3
 
-import os, shutil
+import os, re, shutil
+import ast
 import tempfile
 import logging
 from collections import OrderedDict
 
 log = logging.getLogger('backup.treat')
 
-import common, status, config
+import common, status, config, storage, transfer, journal
 
 def do_treat(args):
     fs_dir = os.path.abspath(".")
@@ -17,42 +18,66 @@ def do_treat(args):
         log.critical("Could not find a repository with {} in copies...".format(fs_dir))
         return
 
+    jobs = int(args["--jobs"]) if args["--jobs"] else config.TRANSFER_JOBS
+
+    if args["resume"]:
+        treat_resume(repo, jobs)
+        return
+
+    if os.path.exists(repo.TREAT_JOURNAL):
+        log.critical("A previous `treat` didn't complete, run `treat resume` first.")
+        return
+    
     if not status.has_status(repo):
         log.critical("Status files are missing, run `status` first.")
         return
     
     if args["new"] or args["all"]:
-        treat_new(repo, fs_dir, delete_on_missing=args["--delete"])
+        treat_new(repo, fs_dir, delete_on_missing=args["--delete"], jobs=jobs)
 
     if args["missing"] or args["all"]:
-        treat_missing(repo, fs_dir)
+        treat_missing(repo, fs_dir, jobs)
     
     if args["updated"] or args["all"]:
-        treat_updated(repo, fs_dir)
+        treat_updated(repo, fs_dir, jobs)
 
     if args["moved"] or args["all"]:
-        treat_moved(repo, fs_dir)
+        treat_moved(repo, fs_dir, jobs)
         
     log.warn("Don't forget to run `status --force` to refresh status files.")
     
-def treat_new(repo, fs_dir, delete_on_missing=False):
-    treat_generic(repo, fs_dir, config.NEW_FILES, delete_on_missing)
+def treat_resume(repo, jobs=1):
+    with journal.Journal(repo.TREAT_JOURNAL) as jrnl:
+        if not jrnl.exists():
+            log.warn("Nothing to resume.")
+            return
+
+        log.info("Resuming treatment: {}.".format(jrnl.summary()))
+        jrnl.run(jobs)
+
+def treat_new(repo, fs_dir, delete_on_missing=False, jobs=1):
+    treat_generic(repo, fs_dir, config.NEW_FILES, delete_on_missing, jobs)
 
-def treat_updated(repo, fs_dir):
-    treat_generic(repo, fs_dir, config.DIFFERENT_FILES)
+def treat_updated(repo, fs_dir, jobs=1):
+    treat_generic(repo, fs_dir, config.DIFFERENT_FILES, jobs=jobs)
 
-def treat_moved(repo, fs_dir):
-    treat_generic(repo, fs_dir, config.MOVED_FILES)
+def treat_moved(repo, fs_dir, jobs=1):
+    treat_generic(repo, fs_dir, config.MOVED_FILES, jobs=jobs)
     return
 
-def treat_missing(repo, fs_dir):
+def treat_missing(repo, fs_dir, jobs=1):
     if repo.get_copies()["master"] == fs_dir:
         log.critical("Current directory is master repository, nothing to do with missing files :(.")
         return
     
-    treat_generic(repo, fs_dir, config.MISSING_FILES)
+    treat_generic(repo, fs_dir, config.MISSING_FILES, jobs=jobs)
     
-def treat_generic(repo, fs_dir, status_file, delete_on_missing=False):
+def parse_difference(info_txt):
+    # info of different.txt: key: (database value, filesystem value), ...
+    return OrderedDict((key, ast.literal_eval(values))
+                       for key, values in re.findall(r"(\w+): (\([^)]*\))", info_txt))
+
+def treat_generic(repo, fs_dir, status_file, delete_on_missing=False, jobs=1):
     origin = repo.get_copies()["master"]
     do_difference = status_file == config.DIFFERENT_FILES
     do_move = status_file == config.MOVED_FILES
@@ -65,15 +90,25 @@ def treat_generic(repo, fs_dir, status_file, delete_on_missing=False):
         for line in status_f.readlines():
             fname, _, info_str = line[:-1].partition(" -> ")
             
-            status_files[fname] = OrderedDict(item.split(": ") for item in info_str.split(", "))
+            status_files[fname] = parse_difference(info_str) if do_difference else common.parse_info(info_str)
             
-            assert do_move and "moved_from" in status_files[fname]
+            assert not do_move or "moved_from" in status_files[fname]
                 
     tmpdir = tempfile.mkdtemp()
     
     status_dir = os.path.join(tmpdir, status_descr.lower().replace(" ", "_"))
     os.mkdir(status_dir)
 
+    def get_symlink_name(status, from_path):
+        filename = status.replace(os.path.sep, "_")
+        
+        if do_difference:
+            return get_filename_for_diff(filename, from_path)
+        elif do_move:
+            return "{} from {}".format(filename, status_files[status]["moved_from"].replace(os.path.sep, "_"))
+        else:
+            return filename
+    
     def get_filename_for_diff(filename, from_path):
         if origin == fs_dir:
             return filename
@@ -85,19 +120,9 @@ def treat_generic(repo, fs_dir, status_file, delete_on_missing=False):
     for status in list(status_files):
         def symlink(from_path):
             src = os.path.join(from_path, status)
-
-            #filename = status.replace(os.path.sep, "_")
-            
-            if do_difference:
-                filename = get_filename_for_diff(status, from_path)
-            elif do_move:
-                filename = "{} from {}".format(status, status_files[status]["moved_from"])
-            else:
-                filename = status
-                
             
             log.info("{} in <{}> {}".format(status_descr, repo.copyname, status))
-            os.symlink(src, os.path.join(status_dir, filename))
+            os.symlink(src, os.path.join(status_dir, get_symlink_name(status, from_path)))
         
         def is_consistent(local_should_exist, origin_should_exist, filename=status):
             def _is_consistent(at_origin, should_exist):
@@ -126,12 +151,14 @@ def treat_generic(repo, fs_dir, status_file, delete_on_missing=False):
                                          is_consistent(local_should_exist=False, origin_should_exist=True, filename=status_files[status]["moved_from"]))
             }
             
-        if not test_consistency[status_file]:
+        # on master, local and origin files are the same
+        if origin != fs_dir and not test_consistency[status_file]():
             has_incorrect = True
             del status_files[status]
             continue
-        
-        symlink(origin)
+
+        # link to where the file currently is
+        symlink(fs_dir if status_file in (config.NEW_FILES, config.MOVED_FILES) else origin)
         
         if do_difference:
             if origin != fs_dir:
@@ -180,55 +207,62 @@ def treat_generic(repo, fs_dir, status_file, delete_on_missing=False):
         log.error("Consider running `update` instead, or `status ... --delete`.")
         return
     
+    database = storage.open_database(repo)
+    
+    # planned in the journal, then run all together
+    operations = []
     for status in status_files:
-        filename = status.replace(os.path.sep, "_")
+        def save_file(from_path, to_path, expected=None):
+            log.critical("Copy {} to {}.".format(os.path.join(from_path, status), to_path))
 
-        def save_file(from_path, to_path):
-            log.critical("Copy {} to {}.".format(os.path.join(origin, status), fs_dir))
-        
-            src = os.path.join(from_path, status)
-            dst = os.path.join(to_path, status)
+            operations.append(transfer.Transfer(os.path.join(from_path, status),
+                                                os.path.join(to_path, status),
+                                                expected or None))
 
-            dst_dir = dst.rpartition(os.path.sep)[0]
+        def move_file():
+            moved_from = status_files[status]["moved_from"]
+            log.critical("Move {} to {} in {}.".format(moved_from, status, origin))
 
-            if config.NOP: return
-            
-            try: os.mkdir(dst_dir)
-            except FileExistsError: pass # ignore
-        
-            shutil.copy(src, dst)
+            operations.append(journal.Move(os.path.join(origin, moved_from),
+                                           os.path.join(origin, status)))
 
-        def delete_file():
-            log.critical("Delete {} from {}.".format(status, origin))
-            
-            src = os.path.join(origin, status)
-            src_dir = src.rpartition(os.path.sep)[0]
+        def delete_file(from_path):
+            log.critical("Delete {} from {}.".format(status, from_path))
 
-            if config.NOP: return
-            os.remove(src)
-            
-            try: os.rmdir(src_dir)
-            except OSError: pass # ignore
-            
-        if do_difference:
-            local_symname = get_filename_for_diff(filename, fs_dir)
-            origin_symname = get_filename_for_diff(filename, origin)
+            operations.append(journal.Delete(os.path.join(from_path, status)))
 
-            has_local = os.path.exists(local_symname)
-            has_origin = os.path.exists(origin_symname)
+        def is_kept(from_path):
+            return os.path.lexists(os.path.join(status_dir, get_symlink_name(status, from_path)))
+        
+        if do_difference:
+            has_local = is_kept(fs_dir)
+            has_origin = is_kept(origin)
 
             if has_local and has_origin: pass # ignore
-            elif has_local: # keep local
-                save_file(fs_dir, origin)
-            elif has_origin: # keep origin
-                save_file(origin, fs_dir)
+            elif has_local: # keep local, as hashed by the status
+                db_md5sum, fs_md5sum = status_files[status].get("md5sum", (None, None))
+                save_file(fs_dir, origin, fs_md5sum)
+            elif has_origin: # keep origin, which should match the database
+                db_info = database.get(status)
+                save_file(origin, fs_dir, db_info["md5sum"] if db_info else None)
             else:
-                log.warn("{}: local and origin files deleted, nothing to do ...".format(filename))
-                
-        elif os.path.exists(os.path.join(status_dir, filename)):
-            save_file(origin, fs_dir)
+                log.warn("{}: local and origin files deleted, nothing to do ...".format(status))
+
+        elif do_move:
+            if is_kept(fs_dir):
+                move_file()
             
-        elif delete_on_missing:
-            delete_file()
+        elif status_file == config.NEW_FILES:
+            if is_kept(fs_dir):
+                save_file(fs_dir, origin, status_files[status]["md5sum"])
+            elif delete_on_missing:
+                delete_file(fs_dir)
+                
+        elif is_kept(origin): # missing
+            save_file(origin, fs_dir, status_files[status]["md5sum"])
+
+    with journal.Journal(repo.TREAT_JOURNAL) as jrnl:
+        jrnl.plan(operations)
+        jrnl.run(jobs)
             
     shutil.rmtree(tmpdir)
@@ -1,6 +1,6 @@
-import os
+import os, time
 
-import common, status, config
+import common, status, config, hashcache, storage, watch, dirstate, scheduler
 
 import logging; log = logging.getLogger('backup.update')
 
@@ -19,55 +19,204 @@ def do_update(args):
     
     do_checksum = args["--checksum"]
     
-    update_database(repo, fs_dir, do_checksum)
+    # before anything of the copy is read (see watch.py)
+    position = watch.log_position(repo)
+    database = storage.open_database(repo)
+    dir_mtimes = dirstate.snapshot(fs_dir, database.dir_summaries())
+
+    from_status = (not args["--force"] and not args["--rehash"]
+                   and fresh_status(repo, fs_dir, database, do_checksum, args["--fingerprint"]))
     
-def update_database(repo, fs_dir, do_checksum):
-    lists_of_files = status.compare_fs_db(repo, fs_dir, do_checksum, updating=True)
+    with hashcache.HashCache(repo.HASH_CACHE, args["--rehash"]) as cache:
+        update_database(repo, fs_dir, do_checksum, common.get_jobs(args), cache,
+                        args["--fingerprint"], from_status)
+
+        # the database now matches the copy: no dirty directory
+        database = storage.open_database(repo)
+        watch.save_baseline(repo, position, database, set(), do_checksum, args["--fingerprint"])
+        dirstate.save(repo, dir_mtimes, database.dir_summaries(), set(), do_checksum, args["--fingerprint"])
+
+        # only the files of the status were seen
+        if do_checksum and not from_status:
+            cache.compact()
+
+def fresh_status(repo, fs_dir, database, do_checksum, do_fingerprint):
+    # True if the status files can be applied instead of comparing the
+    # copy again: computed as asked by this update, against the same
+    # database, and nothing changed in the copy since the scan started.
+    if not status.has_status(repo):
+        return False
+
+    meta = status.load_meta(repo)
+    if meta is None:
+        reason = "no status metadata"
+    elif not meta["complete"]:
+        reason = "the status didn't scan the whole copy"
+    elif meta["database"] != watch.database_stat(database):
+        reason = "the database changed since the status"
+    elif do_checksum and not meta["checksum"]:
+        reason = "the status was computed without --checksum"
+    elif do_fingerprint and not (meta["fingerprint"] and meta["good"] == "full"):
+        reason = "the status was computed without --fingerprint"
+    elif do_checksum and meta.get("previous"):
+        reason = "checksums of a previous algorithm to replace"
+    elif time.time_ns() - meta["started"] > config.STATUS_MAX_AGE * 10**9:
+        reason = "the status is older than STATUS_MAX_AGE"
+    else:
+        changed = changed_since(fs_dir, meta["started"])
+        reason = changed and "'{}' changed since the status".format(changed)
+
+    if reason:
+        log.info("Comparing the copy with the database: {}.".format(reason))
+        return False
+
+    log.info("Using the status of {} (run `update --force` to compare the copy again).".format(
+            time.ctime(meta["started"] / 10**9)))
+    return True
+
+def changed_since(fs_dir, started):
+    # returns the first directory or file of the copy modified since
+    # `started`: adding, removing or renaming a file changes the mtime of
+    # its directory, writing a file (or its attributes) its ctime, which
+    # can't be set back like the mtime. The files are only stat'ed.
+    since = started - 10**9 # the timestamps of the filesystem are coarser
+
+    ignored = set(config.TO_IGNORE)
+    to_visit = [fs_dir]
+    while to_visit:
+        dirpath = to_visit.pop()
+        try:
+            if os.stat(dirpath).st_mtime_ns >= since:
+                return dirpath
+            
+            with os.scandir(dirpath) as dir_it:
+                for entry in dir_it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in ignored:
+                            to_visit.append(entry.path)
+                        continue
+
+                    if entry.stat().st_ctime_ns >= since:
+                        return entry.path[len(fs_dir)+1:]
+        except OSError:
+            return dirpath
+
+    return None
     
-    new = lists_of_files[config.NEW_FILES]
-    missing = lists_of_files[config.MISSING_FILES]
-    good = lists_of_files[config.GOOD_FILES]
-    different = lists_of_files[config.DIFFERENT_FILES]
-    moved = lists_of_files[config.MOVED_FILES]
-
-    # only skip MISSING
-    to_save = list(good)
-    to_update = list(different)
-
-    if not do_checksum:
-        # force checksum for database entry
-        to_update += new
+class UpdateResults(status.StatusLists):
+    # the good files are passed to the database updater as they are
+    # compared, the others are kept until the moved files are known.
+    def __init__(self, updater, do_fingerprint):
+        super().__init__()
+        self.updater = updater
+        self.do_fingerprint = do_fingerprint
+        
+        self.nb_good = 0
+        self.deferred = [] # good files to put once the database is read
+
+    def add(self, fname, relpath, info):
+        if fname != config.GOOD_FILES:
+            super().add(fname, relpath, info)
+            return
+
+        self.nb_good += 1
+        if not self.do_fingerprint:
+            self.updater.keep(relpath, info)
+        elif self.updater.streaming:
+            self.updater.put(relpath, info) # fingerprint may be new
+        else:
+            self.deferred.append((relpath, info))
+
+    def add_rehashed(self, relpath, info):
+        self.nb_good += 1
+        if self.updater.streaming:
+            self.updater.put(relpath, info)
+        else:
+            self.deferred.append((relpath, info))
+
+    def count(self, fname):
+        return self.nb_good if fname == config.GOOD_FILES else super().count(fname)
+    
+def load_status(repo, database, results):
+    # passes the content of the status files to `results`, like compare_fs_db
+    changed = set()
+    for fname in (config.NEW_FILES, config.MISSING_FILES, config.DIFFERENT_FILES):
+        for relpath, info in status.read_status_file(repo, fname):
+            results.add(fname, relpath, info)
+            changed.add(relpath)
+
+    moved = list(status.read_status_file(repo, config.MOVED_FILES))
+    changed.update(info["moved_from"] for relpath, info in moved)
+    results.add_moved(moved)
+
+    if status.load_meta(repo)["good"] == "full":
+        good = status.read_status_file(repo, config.GOOD_FILES)
     else:
-        to_save += new
+        good = (entry for entry in database.browse() if entry and entry[0] not in changed)
+
+    for relpath, info in good:
+        results.add(config.GOOD_FILES, relpath, info)
+
+def update_database(repo, fs_dir, do_checksum, jobs=1, cache=None, do_fingerprint=False, from_status=False):
+    # from_status: apply the status files instead of comparing the copy
+    database = storage.open_database(repo)
     
-    for fname, old_info in to_update:
+    def file_info(entry):
+        fname, old_info = entry
         fs_fullpath = os.path.join(fs_dir, fname)
-        info = common.get_file_info(fs_fullpath, do_checksum=True)
+        
+        return fname, common.get_file_info(fs_fullpath, do_checksum=True, cache=cache,
+                                           algorithm=database.algorithm,
+                                           do_fingerprint=do_fingerprint)
 
-        to_save.append((fname, info))
-                       
-    for fname, info in moved:
-        del info["moved_from"]
-        to_save.append((fname, info))
-
-    # sort to match DB order
-    to_save = sorted(to_save, key=lambda entry: entry[0])
+    with database.updater() as updater:
+        results = UpdateResults(updater, do_fingerprint)
+        if from_status:
+            load_status(repo, database, results)
+        else:
+            status.compare_fs_db(repo, fs_dir, do_checksum, updating=True, jobs=jobs, cache=cache,
+                                 do_fingerprint=do_fingerprint, database=database, results=results)
     
-    tmp_db_file = "{}.tmp".format(repo.db_file)    
-    with open(tmp_db_file, "w+") as tmp_db_f:
-        for fname, info in to_save:
-            common.print_a_file(fname, info, tmp_db_f)
+        new = results.lists[config.NEW_FILES]
+        missing = results.lists[config.MISSING_FILES]
+        different = results.lists[config.DIFFERENT_FILES]
+        moved = results.lists[config.MOVED_FILES]
 
-    try: os.remove(repo.db_file)
-    except OSError: pass
+        # only skip MISSING
+        to_update = list(different) # checksums computed by the status are in the cache
+        to_save = list(results.deferred)
 
-    os.rename(tmp_db_file, repo.db_file)
+        for entry in new:
+            if entry[1]["md5sum"]:
+                to_save.append(entry)
+            else:
+                # force checksum for database entry
+                to_update.append(entry)
+
+        for fname, info in to_save:
+            updater.put(fname, info)
+        
+        def fullpath(entry):
+            return os.path.join(fs_dir, entry[0])
+            
+        for fname, info in scheduler.scheduled_map(file_info, to_update, jobs,
+                                                   lambda entry: scheduler.read_key(fullpath(entry)),
+                                                   lambda entry: common.readahead(fullpath(entry), cache,
+                                                                                  algorithm=database.algorithm)):
+            updater.put(fname, info)
+
+        for fname, info in missing:
+            updater.delete(fname)
+            
+        for fname, info in moved:
+            updater.delete(info.pop("moved_from"))
+            updater.put(fname, info)
             
     log.warn("Database updated.")
-    log.info("{} entries untouched".format(len(good)))
-    log.info("{} entries added".format(len(missing)))
+    log.info("{} entries untouched".format(results.count(config.GOOD_FILES)))
+    log.info("{} entries added".format(len(new)))
     log.info("{} entries updated".format(len(different)))
-    log.info("{} entries removed".format(len(new)))
+    log.info("{} entries removed".format(len(missing)))
     log.info("{} entries moved".format(len(moved)))
 
     status.do_clean(repo)
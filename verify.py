@@ -1,141 +1,158 @@
 #! /usr/bin/python3
 import os
 import logging
-import config
-
-log = logging.getLogger('backup.verify')
+from collections import OrderedDict
 
+import config, common, storage, progress, profiling, scheduler
 
-database = set()
+log = logging.getLogger('backup.verify')
 
-def prepare_database(repo):
-    global database
-    with open(repo.db_file) as db_f:
-        for line in db_f.readlines():
-            database.add(line.partition(" -> ")[0])
-    
-def in_database(relpath):
-    assert database
-    
-    return relpath in database
+# The status files are checked in a single pass: the database is read
+# once, then the entries of all the status files are checked together,
+# the filesystem by `jobs` threads. With `deep`, the good files are
+# hashed again and compared with the checksum of the database.
+
+# what -> status file, in database, in filesystem
+CHECKS = OrderedDict((("NEW", (config.NEW_FILES, False, True)),
+                      ("MISSING", (config.MISSING_FILES, True, False)),
+                      ("MOVED", (config.MOVED_FILES, True, True)), # moved_from in the database
+                      ("DIFF", (config.DIFFERENT_FILES, True, True)),
+                      ("GOOD", (config.GOOD_FILES, True, True))))
+
+DESCRIPTIONS = OrderedDict((("NEW", "New files:                   "),
+                            ("MISSING", "Missing files:               "),
+                            ("MOVED", "Moved files:                 "),
+                            ("DIFF", "Different files:             "),
+                            ("GOOD", "Good files:                  ")))
+
+def status_entries(repo, what, changed):
+    # yields (what, relpath, relpath in the database) for the status file
+    # of `what`, and adds the database entries it changes to `changed`
+    with open(repo.get_status_fname(CHECKS[what][0])) as status_f:
+        for line in status_f:
+            relpath, _, info = line.rstrip("\n").partition(" -> ")
+            db_relpath = common.parse_info(info)["moved_from"] if what == "MOVED" else relpath
+
+            if what != "GOOD":
+                changed.add(db_relpath)
+            yield what, relpath, db_relpath
+
+def good_count(repo):
+    # the number of good files of GOOD_FILES_MODE = "count", or None
+    with open(repo.GOOD_FILES) as good_f:
+        header = common.parse_db_header(good_f.readline())
 
-def in_filesystem(origin, relpath):
-    path = (relpath if relpath.startswith(origin)
-            else "{}/{}".format(origin, relpath))
-    return os.path.exists(path)
+    return int(header["good"]) if header and "good" in header else None
 
+def verify_all(repo, fs_dir, jobs=None, deep=False):
+    # jobs: files hashed concurrently with `deep` (HASH_JOBS by default),
+    # checked concurrently otherwise (VERIFY_JOBS by default)
+    database = storage.open_database(repo)
+    log.warn("Verify  {} against {}".format(fs_dir, database.path))
 
-def verify_new(repo, origin):
-    prepare_database(repo)
+    # relpath -> (checksum, size) with deep, the entries are only looked up otherwise
+    with profiling.phase("db read"):
+        index = {relpath: (info["md5sum"], int(info["size"])) if deep else None
+                 for relpath, info in filter(None, database.browse())}
 
-    correct = True
-    with open(repo.NEW_FILES) as new_f:
-        for line in new_f.readlines():
-            fname = line.partition(" -> ")[0]
-
-            if in_database(fname):
-                log.warn("NEW: {} found in database".format(fname))
-                correct = False
-            if not in_filesystem(origin, fname):
-                log.warn("NEW: {} not in filesystem".format(fname))
-                correct = False
-    return correct
+    errors = OrderedDict((what, 0) for what in CHECKS)
+    failed = set()
+    changed = set()
 
-def verify_missing(repo, origin):
-    prepare_database(repo)
-
-    correct = True
-    with open(repo.MISSING_FILES) as missing_f:
-        for line in missing_f.readlines():
-            fname = line.partition(" -> ")[0]
-
-            if not in_database(fname):
-                log.warn("MISSING: {} not in database".format(fname))
-                correct = False
-            if in_filesystem(origin, fname):
-                log.warn("MISSING: {} in filesystem".format(fname))
-                correct = False
-    return correct
+    try:
+        nb_good_header = good_count(repo)
+    except OSError:
+        nb_good_header = None # reported with the entries
+
+    def entries():
+        for what in CHECKS:
+            try:
+                if what == "GOOD" and nb_good_header is not None:
+                    if deep:
+                        # the good files are the unchanged entries of the database
+                        yield from ((what, relpath, relpath) for relpath in index if relpath not in changed)
+                    continue
+
+                yield from status_entries(repo, what, changed)
+            except Exception as e:
+                log.error("Could not verify {} files: {}".format(what, e))
+                failed.add(what)
+
+    def check_fs(entry):
+        what, relpath, db_relpath = entry
+        fullpath = os.path.join(fs_dir, relpath)
+
+        if not os.path.exists(fullpath):
+            return entry, False, None
+        if not deep or what != "GOOD" or relpath not in index:
+            return entry, True, None
+
+        md5sum = index[relpath][0]
+        if not md5sum:
+            return entry, True, None
+
+        try:
+            return entry, True, common.checksum(fullpath, common.digest_algorithm(md5sum))
+        except OSError as e:
+            return entry, True, e
+
+    def error(what, msg):
+        log.warn("{}: {}".format(what, msg))
+        errors[what] += 1
+
+    def read_key(entry):
+        what, relpath, db_relpath = entry
+        return scheduler.read_key(os.path.join(fs_dir, relpath)) if what == "GOOD" else None
+
+    def prefetch(entry):
+        what, relpath, db_relpath = entry
+        if what == "GOOD":
+            common.readahead(os.path.join(fs_dir, relpath))
+
+    if deep:
+        checked = scheduler.scheduled_map(check_fs, entries(), jobs or config.HASH_JOBS, read_key, prefetch)
+    else:
+        checked = common.ordered_map(check_fs, entries(), jobs or config.VERIFY_JOBS)
+
+    total_size = sum(size for md5sum, size in index.values()) if deep else None
+    nb_good = 0
+    with progress.Progress(len(index), total_size, by_bytes=deep) as prog:
+        for (what, relpath, db_relpath), in_fs, digest in checked:
+            fname, expect_db, expect_fs = CHECKS[what]
+
+            if (db_relpath in index) != expect_db:
+                error(what, "{}{} {} database".format("moved_from=" if what == "MOVED" else "",
+                                                      db_relpath, "not in" if expect_db else "found in"))
+            if in_fs != expect_fs:
+                error(what, "{} {} filesystem".format(relpath, "not in" if expect_fs else "in"))
+
+            if isinstance(digest, Exception):
+                error(what, "{} could not be hashed: {}".format(relpath, digest))
+            elif digest and digest != index[relpath][0]:
+                error(what, "{} content changed: {} in filesystem, {} in database".format(
+                        relpath, digest, index[relpath][0]))
+
+            if what == "GOOD":
+                nb_good += 1
+                prog.update(nbytes=index[relpath][1] if deep and relpath in index else 0)
+
+    if not failed:
+        if nb_good_header is not None:
+            nb_good = nb_good_header
+
+        # every entry of the database is good, unless changed
+        expected = len(index) - len(changed.intersection(index))
+        if nb_good != expected:
+            error("GOOD", "{} good files, {} entries of the database unchanged".format(nb_good, expected))
 
-def verify_different_good(repo, origin, do_good=False):
-    prepare_database(repo)
     correct = True
-    
-    def verif(what, line):
-        global correct
-        
-        if not in_database(fname):
-            log.warn("{}: {} not in database".format(what, fname))
+    for what, desc in DESCRIPTIONS.items():
+        if what in failed:
             correct = False
-        if not in_filesystem(origin, fname):
-            log.warn("{}: {} not in filesystem".format(what, fname))
+        elif errors[what]:
+            log.warn("{}{} errors".format(desc, errors[what]))
             correct = False
-            
-    
-    with open(repo.DIFFERENT_FILES) as different_f:
-        for line in different_f.readlines():
-            fname = line.partition(" -> ")[0]
-            verif("DIFF", line)
-            
-    if not do_good:
-        return correct
-
-    with open(repo.GOOD_FILES) as good_f:
-        for line in good_f.readlines():
-            fname = line.partition(" -> ")[0]
-
-            verif("GOOD", line)
-            
-    return correct
+        else:
+            log.info("{}Everything OK :)".format(desc))
 
-def verify_moved(repo, origin):
-    prepare_database(repo)
-    
-    correct = True
-    
-    with open(repo.MOVED_FILES) as good_f:
-        for line in good_f.readlines():
-            fname, _, info = line[:-1].partition(" -> ")
-
-            info = {item.split(": ")[0]:item.split(": ")[1] for item in info.split(", ")}
-
-            if not in_filesystem(origin, fname):
-                log.warn("MOVED: {} not in filesystem".format(fname))
-                correct = False
-
-            moved_from = info["moved_from"]
-            if not in_database(moved_from):
-                log.warn("MOVED: moved_from={} not in database".format(moved_from))
-                correct = False
-    
     return correct
-    
-def verify_all(repo, fs_dir):
-    log.warn("Verify  {} against {}".format(fs_dir, repo.db_file))
-              
-    prepare_database(repo)
-
-    try:
-        if verify_new(repo, fs_dir):
-            log.info("New files:                   Everythin OK :)")
-    except Exception as e:
-        log.error("Could not verify new files: {}".format(e))
-
-    try:
-        if verify_missing(repo, fs_dir):
-            log.info("Missing files:               Everythin OK :)")
-    except Exception as e:
-        log.error("Could not verify missing files: {}".format(e))
-        
-    try:
-        if verify_moved(repo, fs_dir):
-            log.info("Moved files:                 Everythin OK :)")
-    except Exception as e:
-        log.error("Could not verify moved files: {}".format(e))
-        
-    try:
-        if verify_different_good(repo, fs_dir, do_good=True):
-            log.info("Different and good files:    Everythin OK :)")
-    except Exception as e:
-        log.error("Could not different/good files: {}".format(e))
-
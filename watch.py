@@ -0,0 +1,432 @@
+import os, sys, time
+import ctypes
+import errno
+import heapq
+import json
+import signal
+import struct
+import uuid
+
+import common, config, scheduler
+
+import logging; log = logging.getLogger('backup.watch')
+
+# `backup.py watch` records the directories changed in the copy, with
+# inotify, in its dirty log (WATCH_DIRTY_FILENAME, in the copy tmp dir):
+#   S <token>   watcher started (the log is truncated)
+#   D <relpath> files of this directory changed
+#   T <relpath> this whole directory tree appeared or disappeared
+#   O           events were lost (queue overflow...)
+#   P           position taken by a scan (see log_position)
+#   E           watcher stopped
+# A line is not repeated, unless a scan took a position since then.
+# A complete `status` (or `update`) saves a baseline: the watcher token,
+# the position of the log when the scan started, the database it was
+# compared to and the directories that were not good. While the same
+# watcher runs, the next `status` only scans the dirty directories, and
+# takes the entries of the others from the database.
+#
+# Ordering: the position is taken (log_position) before the scan reads
+# the copy, the baseline saved with it after the scan. The next status
+# reads the log from that position, so the changes logged during the scan
+# are replayed, whether the scan saw them or not: a directory is scanned
+# again at worst, never missed. A change made before the position but
+# logged after it (inotify latency) is replayed as well. The P marker
+# makes the watcher log again the directories it logged before the
+# position, whose lines would be skipped otherwise.
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR       = 0x40000000
+IN_CLOEXEC     = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+              | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+EVENT = struct.Struct("iIII") # wd, mask, cookie, len
+
+def do_watch(args):
+    fs_dir = os.path.abspath(".")
+
+    repo = common.get_repo(fs_dir)
+    if not repo:
+        log.critical("Could not find a repository with {} in copies...".format(fs_dir))
+        return
+
+    try: os.mkdir(repo.tmp_dir)
+    except FileExistsError: pass # ignore
+
+    state = read_state(repo)
+    if state and is_running(state):
+        log.critical("Copy '{}' is already watched (pid {}).".format(repo.copyname, state["pid"]))
+        return
+
+    # `kill` stops the watch cleanly, like ^C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    try:
+        Watcher(repo, fs_dir).run()
+    except KeyboardInterrupt:
+        print("")
+        log.warn("^C caught, watch stopped.")
+
+class Watcher():
+    def __init__(self, repo, fs_dir):
+        self.repo = repo
+        self.fs_dir = fs_dir
+        self.ignored = set(config.TO_IGNORE)
+
+        self.wds = {} # wd -> relpath of the directory
+        self.written = set() # log lines written since the last position
+        self.size = 0 # of the log, after the last line written
+
+        import ctypes.util # slow to import, only needed here
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.inotify_rm_watch = libc.inotify_rm_watch
+
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+
+    def run(self):
+        token = uuid.uuid4().hex
+
+        # appended to by log_position too
+        open(self.repo.WATCH_DIRTY, "w").close()
+        with open(self.repo.WATCH_DIRTY, "ab", buffering=0) as self.dirty_f:
+            self.record("S", token)
+
+            # watches first, then the state: the changes are recorded
+            # from the moment the state is visible to `status`.
+            log.info("Watching {} ...".format(self.fs_dir))
+            self.add_tree("")
+            log.info("{} directories watched.".format(len(self.wds)))
+
+            write_state(self.repo, {"pid": os.getpid(), "token": token,
+                                    "fs_dir": self.fs_dir, "started": time.time()})
+            try:
+                while self.wds:
+                    self.read_events()
+            finally:
+                self.record("E")
+                os.close(self.fd)
+                try: os.remove(self.repo.WATCH_STATE)
+                except FileNotFoundError: pass
+
+        log.warn("Repository root is gone, watch stopped.")
+
+    def record(self, kind, relpath=""):
+        # don't repeat a line, unless a scan took a position since then:
+        # the log grew without this watcher (see log_position)
+        start = os.fstat(self.dirty_f.fileno()).st_size
+        if start != self.size:
+            self.written.clear()
+
+        line = "{} {}".format(kind, relpath)
+        if line in self.written:
+            return
+
+        data = "{}\n".format(line).encode()
+        self.dirty_f.write(data)
+        self.size = os.fstat(self.dirty_f.fileno()).st_size
+
+        if self.size == start + len(data):
+            self.written.add(line)
+        else:
+            self.written.clear() # position taken meanwhile, before or after the line
+
+    def add_tree(self, relpath):
+        for dirpath, dirnames, _ in os.walk(os.path.join(self.fs_dir, relpath)):
+            dirnames[:] = [name for name in dirnames if name not in self.ignored]
+
+            wd = self.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    log.critical("Too many directories to watch, increase "
+                                 "/proc/sys/fs/inotify/max_user_watches.")
+                    self.record("O")
+                elif err != errno.ENOENT: # already gone
+                    log.error("Cannot watch {}: {}".format(dirpath, os.strerror(err)))
+                    self.record("O")
+                continue
+
+            self.wds[wd] = dirpath[len(self.fs_dir)+1:]
+
+    def remove_tree(self, relpath):
+        prefix = relpath + "/"
+        for wd, dir_relpath in list(self.wds.items()):
+            if dir_relpath == relpath or dir_relpath.startswith(prefix):
+                self.inotify_rm_watch(self.fd, wd)
+                del self.wds[wd]
+
+    def read_events(self):
+        buf = os.read(self.fd, config.WATCH_READ_SIZE)
+
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, name_len = EVENT.unpack_from(buf, offset)
+            name = os.fsdecode(buf[offset+EVENT.size:offset+EVENT.size+name_len].rstrip(b"\0"))
+            offset += EVENT.size + name_len
+
+            self.handle_event(wd, mask, name)
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            log.error("Too many changes at once, some were lost.")
+            self.record("O")
+            return
+
+        if mask & IN_IGNORED:
+            self.wds.pop(wd, None)
+            return
+
+        dir_relpath = self.wds.get(wd)
+        if dir_relpath is None:
+            return # removed watch
+
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if not dir_relpath:
+                self.record("O")
+                self.wds.clear() # root gone, stop
+            return # already reported by the parent directory
+
+        relpath = os.path.join(dir_relpath, name) if dir_relpath else name
+
+        if mask & IN_ISDIR:
+            if name in self.ignored:
+                return
+
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(relpath)
+            elif mask & IN_MOVED_FROM:
+                self.remove_tree(relpath)
+
+            if mask & (IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM):
+                self.record("T", relpath)
+        else:
+            self.record("D", dir_relpath)
+
+def read_state(repo):
+    try:
+        with open(repo.WATCH_STATE) as state_f:
+            return json.load(state_f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def write_state(repo, state):
+    tmp_state_file = "{}.tmp".format(repo.WATCH_STATE)
+    with open(tmp_state_file, "w") as state_f:
+        json.dump(state, state_f)
+    os.replace(tmp_state_file, repo.WATCH_STATE)
+
+def is_running(state):
+    try:
+        os.kill(state["pid"], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # running, as another user
+    return True
+
+def database_stat(database):
+    st = os.stat(database.path)
+    return [st.st_mtime_ns, st.st_size]
+
+def log_position(repo):
+    # to call before a complete scan reads the copy: the changes logged
+    # during the scan are still considered dirty (see the ordering above).
+    state = read_state(repo)
+    if not state or not is_running(state):
+        return None
+
+    # the marker makes the watcher log again the directories it already
+    # logged before it
+    try:
+        fd = os.open(repo.WATCH_DIRTY, os.O_WRONLY | os.O_APPEND)
+    except FileNotFoundError:
+        return None
+
+    try:
+        offset = os.fstat(fd).st_size # the marker is after, maybe after a line of the watcher
+        os.write(fd, b"P \n")
+    finally:
+        os.close(fd)
+
+    return state["token"], offset
+
+def save_baseline(repo, position, database, changed_dirs, do_checksum, do_fingerprint):
+    # position: log_position() before the scan, never after: the events
+    # logged since then are replayed by the next dirty_set
+    # changed_dirs: directories with files not good
+    if position is None:
+        return
+
+    token, offset = position
+
+    baseline = {"token": token, "offset": offset, "database": database_stat(database),
+                "checksum": bool(do_checksum), "fingerprint": bool(do_fingerprint),
+                "dirty": sorted(changed_dirs)}
+
+    tmp_baseline_file = "{}.tmp".format(repo.WATCH_BASELINE)
+    with open(tmp_baseline_file, "w") as baseline_f:
+        json.dump(baseline, baseline_f)
+    os.replace(tmp_baseline_file, repo.WATCH_BASELINE)
+
+def dirty_set(repo, database, do_checksum, do_fingerprint):
+    # returns (dirty dirs, dirty trees), or None if the whole copy must be scanned
+    def full_scan(reason):
+        log.info("Full scan: {}.".format(reason))
+        return None
+
+    state = read_state(repo)
+    if not state or not is_running(state):
+        return full_scan("the copy is not watched")
+
+    try:
+        with open(repo.WATCH_BASELINE) as baseline_f:
+            baseline = json.load(baseline_f)
+    except (FileNotFoundError, ValueError):
+        return full_scan("no complete scan since the watch started")
+
+    if baseline["token"] != state["token"]:
+        return full_scan("no complete scan since the watch started")
+
+    if baseline["database"] != database_stat(database):
+        return full_scan("the database changed since the last complete scan")
+
+    if (do_checksum and not baseline["checksum"]) or (do_fingerprint and not baseline["fingerprint"]):
+        return full_scan("the last complete scan didn't use --checksum/--fingerprint")
+
+    dirty_dirs, dirty_trees = set(baseline["dirty"]), set()
+    with open(repo.WATCH_DIRTY) as dirty_f:
+        dirty_f.seek(baseline["offset"])
+
+        for line in dirty_f:
+            if not line.endswith("\n"):
+                break # being written
+
+            kind, _, relpath = line[:-1].partition(" ")
+            if kind == "O":
+                return full_scan("the watch lost some changes")
+            elif kind == "D":
+                dirty_dirs.add(relpath)
+            elif kind == "T":
+                dirty_trees.add(relpath)
+
+    log.info("Scanning {} changed directories ({} trees).".format(len(dirty_dirs), len(dirty_trees)))
+
+    return dirty_dirs, dirty_trees
+
+def in_trees(relpath, trees):
+    # is relpath (or one of its parent directories) in trees
+    while True:
+        if relpath in trees:
+            return True
+        if not relpath:
+            return False
+        relpath = os.path.dirname(relpath)
+
+def dir_key(relpath):
+    return tuple(relpath.split("/")) if relpath else ()
+
+class Unchanged():
+    # entry of browse_partial for a directory not scanned: the entries of
+    # the database in its files (or its whole tree, if recursive) are good,
+    # status.progress_on_fs_and_db passes them through without comparing
+    # them. Sorted before the files of the directory.
+    def __init__(self, dirpath, recursive):
+        self.dirpath = dirpath
+        self.recursive = recursive
+        self.key = dir_key(dirpath), ""
+
+    def contains(self, relpath):
+        dirpath = os.path.dirname(relpath)
+        if not self.recursive:
+            return dirpath == self.dirpath
+
+        return dir_key(dirpath)[:len(self.key[0])] == self.key[0]
+
+def unchanged(summaries, dirty_dirs, dirty_trees):
+    # Unchanged entries of the directories of the database, in walk order:
+    # one per subtree without dirty directory, one per directory whose own
+    # files only are not dirty.
+    tainted = set() # dirty directories and their parents
+    for dirpath in dirty_dirs | dirty_trees:
+        while dirpath not in tainted:
+            tainted.add(dirpath)
+            if not dirpath:
+                break
+            dirpath = os.path.dirname(dirpath)
+
+    for dirpath in sorted(summaries, key=dir_key):
+        if in_trees(dirpath, dirty_trees) or dirpath in dirty_dirs:
+            continue # scanned
+        if dirpath in tainted:
+            yield Unchanged(dirpath, False)
+        elif not dirpath or os.path.dirname(dirpath) in tainted:
+            yield Unchanged(dirpath, True)
+
+def browse_partial(fs_dir, database, dirty, do_checksum, jobs=1, cache=None, algorithm="md5", do_fingerprint=False):
+    # same as common.browse_filesystem, but only the dirty directories
+    # are scanned: the others are Unchanged entries.
+    dirty_dirs, dirty_trees = dirty
+
+    # trees inside another tree are already walked, same for the dirs
+    dirty_trees = {tree for tree in dirty_trees
+                   if not tree or not in_trees(os.path.dirname(tree), dirty_trees)}
+    dirty_dirs = {dirpath for dirpath in dirty_dirs if not in_trees(dirpath, dirty_trees)}
+
+    def scanned():
+        roots = sorted([(dirpath, False) for dirpath in dirty_dirs]
+                       + [(tree, True) for tree in dirty_trees],
+                       key=lambda root: dir_key(root[0]))
+
+        for relpath, recursive in roots:
+            top = os.path.join(fs_dir, relpath) if relpath else fs_dir
+            if not os.path.isdir(top):
+                continue # removed, its entries are missing
+
+            for entry in common.walk_filesystem(fs_dir, top, recursive):
+                if entry:
+                    yield entry
+
+    def file_info(entry):
+        if isinstance(entry, Unchanged):
+            return entry
+
+        fullpath, relpath, dir_entry = entry
+        return fullpath, relpath, common.get_file_info(fullpath, do_checksum, cache,
+                                                       dir_entry.stat(), algorithm, do_fingerprint)
+
+    entries = heapq.merge(scanned(), unchanged(database.dir_summaries(), dirty_dirs, dirty_trees),
+                          key=lambda entry: entry.key if isinstance(entry, Unchanged)
+                                            else common.path_key(entry[1]))
+
+    def read_key(entry):
+        return None if isinstance(entry, Unchanged) else scheduler.entry_key(entry)
+
+    def prefetch(entry):
+        if not isinstance(entry, Unchanged):
+            fullpath, relpath, dir_entry = entry
+            common.readahead(fullpath, cache, dir_entry.stat(), algorithm)
+
+    if do_checksum or do_fingerprint:
+        yield from scheduler.scheduled_map(file_info, entries, jobs, read_key,
+                                           prefetch if do_checksum else None)
+    else:
+        yield from common.ordered_map(file_info, entries)
+    yield False # end of FS